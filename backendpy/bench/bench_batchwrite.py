@@ -0,0 +1,152 @@
+"""Benchmark for blocked-host batch writes against a local DynamoDB stand-in.
+
+Compares the original pynamodb batch_write() loop (with its fixed sleep per
+item, and one DeleteItem per stale row) against BatchWriter at several
+concurrency levels.
+
+    python backendpy/bench/bench_batchwrite.py --items 250 --latency 0.02
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from models import BlockedHost
+from throttle import BatchWriter
+
+
+def key_of(item):
+    """Returns the hash key from a serialized item or key map"""
+    value = item["hash"]
+    return value["S"] if isinstance(value, dict) else value
+
+
+class FakeTable:
+    """Stands in for a pynamodb TableConnection.  Every call takes a fixed
+    latency, and writes beyond capacity units per second come back as
+    UnprocessedItems, like a throttled table."""
+
+    def __init__(self, latency, capacity):
+        self.latency = latency
+        self.capacity = capacity
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.window = (0, 0)
+
+    def admit(self, wanted):
+        """Returns how many of wanted writes fit in this second's capacity"""
+        with self.lock:
+            second, used = self.window
+            now = int(time.monotonic())
+            if now != second:
+                second, used = (now, 0)
+            ok = max(0, min(wanted, self.capacity - used))
+            self.window = (second, used + ok)
+            return ok
+
+    def batch_write_item(
+        self, put_items=None, delete_items=None, return_consumed_capacity=None
+    ):
+        """Emulates BatchWriteItem"""
+        time.sleep(self.latency)
+        ops = [("put", x) for x in put_items or []]
+        ops += [("delete", x) for x in delete_items or []]
+        ok = self.admit(len(ops))
+        with self.lock:
+            for kind, x in ops[:ok]:
+                if kind == "put":
+                    self.rows[key_of(x)] = x
+                else:
+                    self.rows.pop(key_of(x), None)
+        unprocessed = [
+            (
+                {"PutRequest": {"Item": x}}
+                if kind == "put"
+                else {"DeleteRequest": {"Key": x}}
+            )
+            for (kind, x) in ops[ok:]
+        ]
+        res = {"UnprocessedItems": {}}
+        if unprocessed:
+            res["UnprocessedItems"][BlockedHost.Meta.table_name] = unprocessed
+        if return_consumed_capacity:
+            res["ConsumedCapacity"] = [{"CapacityUnits": float(ok)}]
+        return res
+
+    def delete_item(self, hash_key, *_args, **_kwargs):
+        """Emulates DeleteItem"""
+        time.sleep(self.latency)
+        self.admit(1)
+        with self.lock:
+            self.rows.pop(hash_key, None)
+
+
+def make_items(start, count, ts):
+    """Returns count BlockedHost rows"""
+    return [
+        BlockedHost(f"{i:064x}", host=f"host{i}.example", timestamp=str(ts))
+        for i in range(start, start + count)
+    ]
+
+
+def legacy(items, stale):
+    """The original batch_block_host write and delete phases"""
+    with BlockedHost.batch_write() as batch:
+        for item in items:
+            batch.save(item)
+            time.sleep(0.1)
+    for item in stale:
+        item.delete()
+
+
+def batched(items, stale, concurrency):
+    """The BatchWriter write and delete phases"""
+    with BatchWriter(BlockedHost, concurrency=concurrency) as batch:
+        for item in items:
+            batch.save(item)
+    with BatchWriter(BlockedHost, concurrency=concurrency) as batch:
+        for item in stale:
+            batch.delete(item)
+
+
+def main():
+    """Runs the benchmark and prints items/sec for each mode"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=250)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--capacity", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    modes = [] if args.skip_legacy else [("legacy", legacy)]
+    for n in args.concurrency:
+        modes.append(
+            (f"BatchWriter x{n}", lambda i, s, n=n: batched(i, s, concurrency=n))
+        )
+
+    print(f"{'mode':<18}{'items':>8}{'secs':>10}{'items/sec':>12}")
+    for name, run in modes:
+        table = FakeTable(args.latency, args.capacity)
+        items = make_items(0, args.items, 2)
+        stale = make_items(args.items, args.items // 5, 1)
+        # The stale rows are in the table to begin with, so that missed
+        # deletes show up below.
+        table.rows = {x.hash: x.serialize() for x in stale}
+        with patch.object(BlockedHost, "_get_connection", return_value=table):
+            start = time.monotonic()
+            run(items, stale)
+            secs = time.monotonic() - start
+        total = len(items) + len(stale)
+        assert set(table.rows) == {x.hash for x in items}
+        print(f"{name:<18}{total:>8}{secs:>10.2f}{total / secs:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Micro-benchmark for domain normalization.
+
+Compares the original four-regex cleandomain against the single-pass
+cleandomain and the batch cleandomains, on a mix of input forms.
+
+    python backendpy/bench/bench_cleandomain.py --domains 20000
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from utils import cleandomain, cleandomains
+
+
+def legacy(domain):
+    """The original cleandomain"""
+    if domain is None:
+        return domain
+    ldomain = domain.lower()
+    m = re.match("https://([^/]*)", ldomain)
+    if m is not None:
+        return m.group(1)
+    m = re.match("http://([^/]*)", ldomain)
+    if m is not None:
+        return m.group(1)
+    m = re.match("([^@]*)@([a-zA-Z0-9_.-]*)", ldomain)
+    if m is not None:
+        return m.group(2)
+    return re.sub("[^a-zA-Z0-9_.-]", "", ldomain)
+
+
+def make_domains(count):
+    """Returns count domains in the forms people type them"""
+    forms = [
+        "host{}.example",
+        "Host{}.Example.Social",
+        "https://host{}.example/about",
+        "http://host{}.example",
+        "user@host{}.example",
+        "host{}.example.",
+    ]
+    return [forms[i % len(forms)].format(i) for i in range(count)]
+
+
+def timed(run, repeat):
+    """Returns the best time of a few runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Runs the benchmark and prints domains/sec for each variant"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--domains", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    domains = make_domains(args.domains)
+    modes = [
+        ("legacy", lambda: [legacy(d) for d in domains]),
+        ("cleandomain", lambda: [cleandomain(d) for d in domains]),
+        ("cleandomains", lambda: cleandomains(domains)),
+    ]
+    print(f"{'mode':<14}{'domains':>9}{'secs':>10}{'domains/sec':>14}")
+    for name, run in modes:
+        secs = timed(run, args.repeat)
+        print(f"{name:<14}{len(domains):>9}{secs:>10.4f}{len(domains) / secs:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Cold-start benchmark for the Python Lambda handlers.
+
+Imports each handler module in a fresh interpreter with -X importtime, and
+reports the median cumulative import time and the heaviest dependencies it
+loaded.  Exits non-zero if a module goes over its budget, or loads a
+dependency that its handlers are meant to defer.
+
+    python backendpy/bench/bench_coldstart.py --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Handler module -> import budget in ms.  These are generous, so that only
+# real regressions (like a new eager import of a heavy library) trip them.
+BUDGETS = {
+    "shared": 400,
+    "server": 400,
+    "client": 400,
+    "telemetry": 80,
+    "other": 400,
+}
+
+# Libraries a module must not load at import time.
+DEFERRED = {
+    "shared": ["mastodon"],
+    "server": ["mastodon"],
+    "client": ["mastodon"],
+    "telemetry": ["mastodon", "pynamodb", "requests", "sourcemap", "smap"],
+}
+
+# Top-level packages we depend on, for the per-module breakdown.
+LIBRARIES = ["mastodon", "pynamodb", "botocore", "requests", "sourcemap", "smap"]
+
+
+def import_times(module):
+    """Imports module in a new interpreter, returning {name: cumulative us}
+    for every module that was actually executed"""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def check(module, runs):
+    """Returns (median ms, {library: ms}, problems) for one module"""
+    samples = [import_times(module) for _ in range(runs)]
+    median = statistics.median(x[module] for x in samples) / 1000
+    libraries = {}
+    for name, us in samples[-1].items():
+        lib = name.split(".")[0]
+        if lib in LIBRARIES:
+            # Submodules are nested in their package's time, or imported
+            # separately from it, so the largest is a fair estimate.
+            libraries[lib] = max(libraries.get(lib, 0), us / 1000)
+    problems = [
+        f"{module} loads {lib} at import"
+        for lib in DEFERRED.get(module, [])
+        if lib in libraries
+    ]
+    if median > BUDGETS[module]:
+        problems.append(f"{module} took {median:.1f}ms (budget {BUDGETS[module]}ms)")
+    return (median, libraries, problems)
+
+
+def main():
+    """Runs the benchmark and prints import time for each handler module"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    args = parser.parse_args()
+
+    print(f"{'module':<12}{'ms':>9}{'budget':>9}  heaviest dependencies")
+    problems = []
+    for module in args.modules:
+        median, libraries, errors = check(module, args.runs)
+        problems.extend(errors)
+        heaviest = ", ".join(
+            f"{lib} {ms:.0f}ms"
+            for (lib, ms) in sorted(libraries.items(), key=lambda x: -x[1])
+        )
+        print(f"{module:<12}{median:>9.1f}{BUDGETS[module]:>9}  {heaviest or '-'}")
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
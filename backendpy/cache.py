@@ -0,0 +1,65 @@
+"""Small in-process caches that survive across warm Lambda invocations"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get when there is no live entry, so that None can be
+# cached as a legitimate value.
+MISSING = object()
+
+
+class TTLCache:
+    """A size-bounded LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, maxsize=128, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        """Returns the live value for key, or default"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                (value, expires) = entry
+                if expires > self.timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key, evicting the least recently used entries"""
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, self.timer() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Drops any entry for key"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drops every entry and resets the statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns hit/miss counts and the current size"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
@@ -3,14 +3,12 @@
 import json
 import logging
 
-from mastodon import (
-    MastodonAPIError,
-)
-
 from factory import MastodonFactory, NoAuthInfo
 from models import Datastore
 from shared import callback_helper
-from utils import err_response, response
+from utils import lazy_import, err_response, response
+
+mastodonpy = lazy_import("mastodon")
 
 
 def clientlogout(event, _):
@@ -28,8 +26,9 @@ def clientlogout(event, _):
 
         mastodon = MastodonFactory.from_config(cfg, token=token)
         mastodon.revoke_access_token()
+        MastodonFactory.evict(mastodon)
 
-    except MastodonAPIError as e:
+    except mastodonpy.MastodonAPIError as e:
         logging.error("ERROR - other API error: %s", str(e))
         return err_response("ERROR - API error")
     except NoAuthInfo:
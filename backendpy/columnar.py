@@ -0,0 +1,82 @@
+"""A file format for data held in parallel typed arrays.
+
+A file is a header (magic, row count, and the length of the strings), each
+column's raw array bytes in turn, then a JSON object of strings and other
+small values.  Loaded files are memory-mapped, and the columns read straight
+from the map without being copied.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+from array import array
+
+HEADER = struct.Struct("<8sQQ")
+
+
+class ColumnFile(ABC):
+    """Base for classes held in parallel arrays that save to, and load from,
+    column files.
+
+    Subclasses set MAGIC and TYPECODES (one array typecode per column), and
+    implement parts() and from_parts()."""
+
+    MAGIC = b""
+    TYPECODES = ()
+
+    # The mmap (if any) that the columns point into, kept alive with them
+    buf = None
+
+    @abstractmethod
+    def parts(self):
+        """Returns (columns, strings) to save: the arrays, in TYPECODES
+        order, and a JSON-able dict"""
+
+    @classmethod
+    @abstractmethod
+    def from_parts(cls, columns, strings, buf):
+        """Builds an instance from loaded columns and strings.  buf is what
+        the columns point into, which the instance must keep alive."""
+
+    def dumps(self):
+        """Serializes into the file format"""
+        columns, strings = self.parts()
+        strings = json.dumps(strings).encode("utf-8")
+        count = len(columns[0]) if columns else 0
+        parts = [HEADER.pack(self.MAGIC, count, len(strings))]
+        parts.extend(bytes(c) for c in columns)
+        parts.append(strings)
+        return b"".join(parts)
+
+    @classmethod
+    def frombuffer(cls, buf):
+        """Returns an instance that reads its columns directly from buf"""
+        magic, count, strlen = HEADER.unpack_from(buf)
+        if magic != cls.MAGIC:
+            raise ValueError(f"Not a {cls.__name__} file")
+        view = memoryview(buf)
+        pos = HEADER.size
+        columns = []
+        for code in cls.TYPECODES:
+            width = array(code).itemsize
+            columns.append(view[pos : pos + count * width].cast(code))
+            pos += count * width
+        strings = json.loads(bytes(view[pos : pos + strlen]))
+        return cls.from_parts(columns, strings, buf)
+
+    def save(self, path):
+        """Writes to path atomically"""
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            f.write(self.dumps())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a file"""
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.frombuffer(buf)
@@ -1,13 +1,39 @@
 """Factory class for Mastodon instances"""
 
-from mastodon import (
-    Mastodon,
-)
-from models import Datastore
+import os
+import time
+
+from cache import MISSING, TTLCache
+from models import AuthSession, Datastore
+from utils import lazy_import
+
+# Mastodon.py and requests are only loaded once a client is actually built.
+mastodonpy = lazy_import("mastodon")
+requests = lazy_import("requests")
 
 # Our User Agent
 USER_AGENT = "mastodonlistmanager"
 
+# How long (in seconds) to trust a probed instance version, and how long to
+# remember that a host didn't look like Mastodon at all.
+VERSION_TTL = int(os.environ.get("VERSION_TTL", "3600"))
+NOT_MASTODON_TTL = int(os.environ.get("NOT_MASTODON_TTL", "300"))
+
+# Set to also store probed versions in the HostConfig table, so that cold
+# containers can skip the probe too.
+PERSIST_VERSION = os.environ.get("PERSIST_HOST_VERSION", "") != ""
+
+# host -> version string, or None for hosts that failed the version check.
+# Module level so that it lives across warm invocations.
+version_cache = TTLCache(maxsize=1024, ttl=VERSION_TTL)
+
+# Ready-to-use clients keyed by (api_base_url, client_id, token), and one keep-alive
+# session per host that those clients share, so warm invocations skip the
+# TCP and TLS handshakes.
+CLIENT_TTL = int(os.environ.get("CLIENT_TTL", "900"))
+client_pool = TTLCache(maxsize=256, ttl=CLIENT_TTL)
+session_pool = TTLCache(maxsize=64, ttl=CLIENT_TTL)
+
 
 class NoAuthInfo(Exception):
     """Internal exception class for when we don't have auth info"""
@@ -17,6 +43,28 @@ class NotMastodon(Exception):
     """Internal exception for when we think we don't have a Mastodon connection"""
 
 
+def stored_version(cfg):
+    """Returns the version stored with a HostConfig if it is still fresh"""
+    version = getattr(cfg, "version", None)
+    checked = getattr(cfg, "version_checked", None)
+    if not isinstance(version, str) or not isinstance(checked, (int, float)):
+        return None
+    if time.time() - checked > VERSION_TTL:
+        return None
+    return version
+
+
+def host_session(host):
+    """Returns the shared keep-alive requests session for a host"""
+    session = session_pool.get(host)
+    if session is MISSING:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount("https://", adapter)
+        session_pool.set(host, session)
+    return session
+
+
 class MastodonFactory:
     """Factory class for Mastodon instances"""
 
@@ -26,6 +74,7 @@ class MastodonFactory:
         authinfo = Datastore.get_auth(cookie)
         if authinfo is None:
             raise NoAuthInfo
+        AuthSession.renew(authinfo)
 
         # Get the configuration that we need
         cfg = Datastore.get_host_config(authinfo.domain)
@@ -37,16 +86,59 @@ class MastodonFactory:
     @classmethod
     def from_config(cls, cfg, token=None):
         """Create a Mastodon interface from a HostConfig object"""
-        mastodon = Mastodon(
+        base_url = f"https://{cfg.host}"
+        key = (base_url, cfg.client_id, token)
+        mastodon = client_pool.get(key)
+        if mastodon is not MISSING:
+            return mastodon
+
+        version = version_cache.get(cfg.host)
+        if version is None:
+            # Recently failed the version check, don't bother probing again.
+            raise NotMastodon
+        if version is MISSING:
+            version = stored_version(cfg)
+
+        # Passing a known version skips Mastodon.py's /api/v1/instance probe.
+        mastodon = mastodonpy.Mastodon(
             client_id=cfg.client_id,
             client_secret=cfg.client_secret,
             access_token=token,
             user_agent=USER_AGENT,
-            api_base_url=f"https://{cfg.host}",
+            api_base_url=base_url,
+            mastodon_version=version,
+            session=host_session(cfg.host),
         )
+        if version is not None:
+            version_cache.set(cfg.host, version)
+            client_pool.set(key, mastodon)
+            return mastodon
+
         # If the version check failed, then most likely this is an unusable
         # instance.  This can happen when e.g. we are blocked by CloudFlare
         if not mastodon.version_check_worked:
+            version_cache.set(cfg.host, None, ttl=NOT_MASTODON_TTL)
             raise NotMastodon
 
+        version = (
+            f"{mastodon.mastodon_major}.{mastodon.mastodon_minor}."
+            f"{mastodon.mastodon_patch}"
+        )
+        version_cache.set(cfg.host, version)
+        if PERSIST_VERSION:
+            Datastore.set_host_version(cfg.host, version, int(time.time()))
+
+        client_pool.set(key, mastodon)
         return mastodon
+
+    @classmethod
+    def evict(cls, mastodon):
+        """Drops a client from the pool, e.g. after its token is revoked"""
+        client_pool.pop(
+            (mastodon.api_base_url, mastodon.client_id, mastodon.access_token)
+        )
+
+    @classmethod
+    def pool_stats(cls):
+        """Returns hit/miss counts for the client pool"""
+        return client_pool.stats()
@@ -1,25 +1,57 @@
 """Models for DynamoDB access"""
 
-import datetime
 import hashlib
+import logging
 import os
 import time
+import uuid
 
+from pynamodb.exceptions import DeleteError, PutError, UpdateError
 from pynamodb.models import Model
 from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
-from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.attributes import (
+    BinaryAttribute,
+    MapAttribute,
+    NumberAttribute,
+    UnicodeAttribute,
+    UnicodeSetAttribute,
+)
+
+import sessions
+from cache import MISSING, TTLCache
+from throttle import BatchWriter
 
 
 class MyModel(Model):
     """An extension to pynamodb.Model"""
 
     @classmethod
-    def lookup(cls, key):
+    def lookup(cls, key, consistent_read=False, attributes_to_get=None):
         """Lookup a single value or return none"""
-        res = list(cls.query(key))
-        if len(res) == 0:
+        # All of our tables are hash-key only, so a GetItem is cheaper than
+        # a Query.
+        try:
+            return cls.get(
+                key,
+                consistent_read=consistent_read,
+                attributes_to_get=attributes_to_get,
+            )
+        except cls.DoesNotExist:
             return None
-        return res[0]
+
+    @classmethod
+    def lookup_many(cls, keys, consistent_read=False, attributes_to_get=None):
+        """Lookup several values with BatchGetItem, returning a dict from
+        hash key to item.  Keys that don't exist are left out."""
+        hash_key = cls._hash_key_attribute().attr_name
+        return {
+            getattr(item, hash_key): item
+            for item in cls.batch_get(
+                set(keys),
+                consistent_read=consistent_read,
+                attributes_to_get=attributes_to_get,
+            )
+        }
 
 
 class AuthTable(MyModel):
@@ -37,6 +69,25 @@ class AuthTable(MyModel):
     token = UnicodeAttribute()
     domain = UnicodeAttribute()
     expires_at = NumberAttribute()
+    # When the token was last checked against its server, see
+    # AuthSession.set_verified.
+    verified_at = NumberAttribute(null=True)
+
+
+class RevokedSession(MyModel):
+    """
+    Sealed session cookies that were logged out before they expired
+    """
+
+    class Meta:
+        """Metadata for this table"""
+
+        table_name = os.environ.get("TABLE_REVOKED", "list-manager-revokedSessions-dev")
+        region = "us-west-2"
+
+    jti = UnicodeAttribute(hash_key=True)
+    # Deleted by DynamoDB once the cookie would have expired anyway
+    expires_at = NumberAttribute()
 
 
 class AllowedHost(MyModel):
@@ -69,6 +120,28 @@ class BlockedHost(MyModel):
     timestamp = UnicodeAttribute()
 
 
+class BlockFilter(MyModel):
+    """
+    A compact, precomputed copy of the blocked and allowed host lists
+    """
+
+    class Meta:
+        """Metadata for this table"""
+
+        table_name = os.environ.get("TABLE_FILTER", "list-manager-blockFilter-dev")
+        region = "us-west-2"
+
+    name = UnicodeAttribute(hash_key=True)
+    # Sorted, concatenated DIGEST_PREFIX-byte prefixes of blocked host digests
+    digests = BinaryAttribute(legacy_encoding=False)
+    allowed = UnicodeSetAttribute(null=True)
+    timestamp = NumberAttribute()
+    # Upstream source URL -> {"etag", "last_modified"} from the last fetch
+    sources = MapAttribute(null=True)
+    # Hash of the full set of digests, see digests_hash()
+    content_hash = UnicodeAttribute(null=True)
+
+
 class HostConfig(MyModel):
     """
     A list of allowed hosts
@@ -81,25 +154,159 @@ class HostConfig(MyModel):
         region = "us-west-2"
 
     host = UnicodeAttribute(hash_key=True)
-    client_id = UnicodeAttribute()
-    client_secret = UnicodeAttribute()
+    # Unset while an app is being registered on the host, see
+    # AppLease.acquire.
+    client_id = UnicodeAttribute(null=True)
+    client_secret = UnicodeAttribute(null=True)
+    # Last probed Mastodon version for the host, and when we probed it.
+    version = UnicodeAttribute(null=True)
+    version_checked = NumberAttribute(null=True)
+    # Who is registering an app on the host, and until when.
+    lease_owner = UnicodeAttribute(null=True)
+    lease_expires = NumberAttribute(null=True)
+
+
+# How many BatchWriteItem calls bulk operations may have in flight at once
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "4"))
+
+# How long (in seconds) a session lasts after it was last renewed, and how
+# close to expiry it must be before use renews it.  DynamoDB deletes expired
+# rows itself (see the TTL in serverless/tables.yml), but only eventually.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(24 * 3600)))
+SESSION_RENEW = int(os.environ.get("SESSION_RENEW", str(6 * 3600)))
+
+# The error DynamoDB gives when a write's condition isn't met
+CONDITION_FAILED = "ConditionalCheckFailedException"
+
+# Bytes of each SHA-256 host digest kept in the block filter.  Matches on a
+# prefix are confirmed against the BlockedHost table.
+DIGEST_PREFIX = 8
+
+
+def host_digest(host):
+    """Returns the hex SHA-256 digest that blocked hosts are stored under"""
+    m = hashlib.sha256()
+    m.update(host.encode("utf-8"))
+    return m.hexdigest()
+
+
+def host_suffixes(host):
+    """Returns a host and each of its parent domains, short of the bare TLD.
+    A block on any of them applies to the host."""
+    labels = host.split(".")
+    return [".".join(labels[i:]) for i in range(max(1, len(labels) - 1))]
+
+
+def digests_hash(digests):
+    """Returns a stable hash of a set of host digests"""
+    m = hashlib.sha256()
+    for digest in sorted(digests):
+        m.update(digest.encode("utf-8"))
+    return m.hexdigest()
+
+
+class HostFilter:
+    """In-memory view of a BlockFilter row"""
+
+    def __init__(self, digests, allowed):
+        self.prefixes = {
+            digests[i : i + DIGEST_PREFIX]
+            for i in range(0, len(digests), DIGEST_PREFIX)
+        }
+        self.allowed = set(allowed or ())
+
+    @classmethod
+    def pack(cls, digests):
+        """Packs hex digests into the sorted prefix array stored in BlockFilter"""
+        prefixes = {bytes.fromhex(d)[:DIGEST_PREFIX] for d in digests}
+        return b"".join(sorted(prefixes))
+
+    def may_block(self, sha):
+        """Returns true if the digest might be on the blocklist"""
+        return bytes.fromhex(sha)[:DIGEST_PREFIX] in self.prefixes
+
+    def candidates(self, digests):
+        """Returns the digests that might be on the blocklist"""
+        return [sha for sha in digests if self.may_block(sha)]
 
 
 def get_expire():
-    """Compute a 1-day expire time"""
-    now = datetime.datetime.now()
-    expire = now + datetime.timedelta(days=1)
-    unix = time.mktime(expire.timetuple())
-    return unix
+    """Compute the expire time for a new or renewed session"""
+    return int(time.time()) + SESSION_TTL
+
+
+def make_caches():
+    """Builds the default per-table read-through caches"""
+    return {
+        "auth": TTLCache(maxsize=1024, ttl=int(os.environ.get("CACHE_TTL_AUTH", "60"))),
+        "revoked": TTLCache(
+            maxsize=1024, ttl=int(os.environ.get("CACHE_TTL_AUTH", "60"))
+        ),
+        "hostcfg": TTLCache(
+            maxsize=1024, ttl=int(os.environ.get("CACHE_TTL_HOSTCFG", "600"))
+        ),
+        "allowed": TTLCache(
+            maxsize=4096, ttl=int(os.environ.get("CACHE_TTL_ALLOWED", "600"))
+        ),
+        "filter": TTLCache(
+            maxsize=1, ttl=int(os.environ.get("CACHE_TTL_FILTER", "3600"))
+        ),
+    }
 
 
 class Datastore:
     """A mockable interface to the above ORM classes"""
 
+    # Read-through caches, keyed by table.  Anything with the TTLCache
+    # get/set/pop/clear interface can be plugged in here.
+    caches = make_caches()
+
+    @classmethod
+    def cached(cls, table, key, load):
+        """Returns the cached value for key, calling load() on a miss"""
+        cache = cls.caches[table]
+        value = cache.get(key)
+        if value is MISSING:
+            value = load()
+            cache.set(key, value)
+        return value
+
+    @classmethod
+    def clear_caches(cls):
+        """Empties every read-through cache"""
+        for cache in cls.caches.values():
+            cache.clear()
+
     @classmethod
     def get_auth(cls, cookie):
-        """Given a cookie, returns any auth associated with it or None"""
-        return AuthTable.lookup(cookie)
+        """Given a cookie, returns any unexpired auth associated with it or
+        None"""
+        if sessions.is_sealed(cookie):
+            # Everything we need is in the cookie itself, unless it has been
+            # logged out.
+            session = sessions.open_cookie(cookie)
+            if session is None:
+                return None
+            revoked = cls.cached(
+                "revoked", session.jti, lambda: RevokedSession.lookup(session.jti)
+            )
+            return session if revoked is None else None
+        authinfo = cls.cached("auth", cookie, lambda: AuthTable.lookup(cookie))
+        if authinfo is not None and authinfo.expires_at <= time.time():
+            # Expired, but not yet deleted by DynamoDB
+            cls.caches["auth"].pop(cookie)
+            return None
+        return authinfo
+
+    @classmethod
+    def new_session(cls, token, domain):
+        """Starts a session, returning its cookie: a sealed cookie if they
+        are configured, or else a key into the auth table"""
+        if sessions.enabled():
+            return sessions.seal(domain, token, get_expire())
+        cookie = uuid.uuid4().urn
+        cls.set_auth(cookie, token=token, domain=domain)
+        return cookie
 
     @classmethod
     def set_auth(cls, cookie, token, domain):
@@ -108,66 +315,212 @@ class Datastore:
             cookie, token=token, domain=domain, expires_at=get_expire()
         )
         authinfo.save()
+        cls.caches["auth"].pop(cookie)
 
     @classmethod
     def drop_auth(cls, cookie):
         """Drop the token associated with the cookie"""
         authinfo = cls.get_auth(cookie)
-        if authinfo is not None:
+        if isinstance(authinfo, sessions.Session):
+            # The cookie stays valid until it expires, unless we remember it
+            # somewhere every handler looks.
+            revoked = RevokedSession(authinfo.jti, expires_at=authinfo.expires_at)
+            revoked.save()
+            cls.caches["revoked"].set(authinfo.jti, revoked)
+        elif authinfo is not None:
             authinfo.delete()
+        cls.caches["auth"].pop(cookie)
 
     @classmethod
     def is_allowed(cls, host):
         """Returns true if this host is allowed"""
-
-        # Host is blocked if on the blocklist, unless it is also on the allow
-        # list.
         lhost = host.lower().strip()
+        return cls.cached("allowed", lhost, lambda: cls.lookup_allowed(lhost))
+
+    @classmethod
+    def lookup_allowed(cls, lhost):
+        """Checks the allow and block tables for a host"""
+
+        # Hosts are stored as a hash, and a block on a domain also covers
+        # its subdomains, so we check the digest of every suffix.
+        digests = [host_digest(x) for x in host_suffixes(lhost)]
+
+        # Most hosts aren't anywhere near the blocklist, and the block filter
+        # can tell us that without touching DynamoDB.
+        hostfilter = cls.get_block_filter()
+        if hostfilter is not None:
+            if lhost in hostfilter.allowed:
+                return True
+            digests = hostfilter.candidates(digests)
+            if not digests:
+                return True
+
+        # Host is blocked if it or a parent is on the blocklist, unless it is
+        # also on the allow list.
         allow = AllowedHost.lookup(lhost)
         if allow is not None:
             return True
 
-        # Hosts are stored as a hash
-        m = hashlib.sha256()
-        m.update(lhost.encode("utf-8"))
-        sha = m.hexdigest()
-        block = BlockedHost.lookup(sha)
-        return block is None
+        if len(digests) == 1:
+            return BlockedHost.lookup(digests[0]) is None
+        return not BlockedHost.lookup_many(digests, attributes_to_get=["hash"])
+
+    @classmethod
+    def get_block_filter(cls):
+        """Returns the published HostFilter, or None if there isn't one"""
+
+        def load():
+            row = BlockFilter.lookup("blocked")
+            if row is None:
+                return None
+            return HostFilter(row.digests, row.allowed)
+
+        return cls.cached("filter", "blocked", load)
+
+    @classmethod
+    def get_block_filter_row(cls):
+        """Returns the published BlockFilter row itself, bypassing caches"""
+        return BlockFilter.lookup("blocked", consistent_read=True)
+
+    @classmethod
+    def publish_block_filter(cls, digests, ts, sources=None, allowed=None):
+        """Publishes a BlockFilter built from the blocked host digests and the
+        allowed hosts (by default, the current ones)"""
+        if allowed is None:
+            allowed = {x.host for x in AllowedHost.scan()}
+        row = BlockFilter(
+            "blocked",
+            digests=HostFilter.pack(digests),
+            allowed=allowed or None,
+            timestamp=ts,
+            sources=sources,
+            content_hash=digests_hash(digests),
+        )
+        row.save()
+        cls.caches["filter"].clear()
+        cls.caches["allowed"].clear()
+
+    @classmethod
+    def refresh_block_filter(
+        cls, digests=None, ts=None, sources=None, allowed_only=False
+    ):
+        """Republishes the block filter if the blocked or allowed hosts have
+        changed since it was published, or else just records sources.
+        Without digests, the published filter (if any) is refreshed from the
+        blocked table; with allowed_only, only if the allowed hosts have
+        changed.  Returns true if it was republished."""
+        row = cls.get_block_filter_row()
+        allowed = {x.host for x in AllowedHost.scan()}
+        if digests is None:
+            if row is None:
+                # Nothing published, so lookups already go to the tables.
+                return False
+            if allowed_only and set(row.allowed or ()) == allowed:
+                return False
+            digests = {x.hash for x in BlockedHost.scan(attributes_to_get=["hash"])}
+            ts = row.timestamp
+            sources = row.sources.as_dict() if row.sources else None
+
+        if (
+            row is not None
+            and row.content_hash == digests_hash(digests)
+            and set(row.allowed or ()) == allowed
+        ):
+            if sources is not None:
+                cls.set_block_sources(sources)
+            return False
+        cls.publish_block_filter(digests, ts, sources, allowed)
+        return True
+
+    @classmethod
+    def set_block_sources(cls, sources):
+        """Records new upstream validators without republishing the filter"""
+        BlockFilter("blocked").update(actions=[BlockFilter.sources.set(sources)])
 
     @classmethod
     def block_host(cls, sha, host):
         """Adds an entry to the blocked hosts list"""
         bh = BlockedHost(sha, host=host)
         bh.save()
+        cls.caches["allowed"].clear()
+        # Otherwise a published filter would hide the block until the next
+        # block_update.
+        cls.refresh_block_filter()
 
     @classmethod
-    def batch_block_host(cls, hosts, ts):
-        """Adds multiple entries to the blocked host list"""
+    def batch_block_host(cls, hosts, ts, incremental=True):
+        """Replaces the blocked host list with the given entries.  Returns
+        the number of rows written and deleted."""
+        if incremental:
+            res = cls.sync_blocked_hosts(hosts, ts)
+        else:
+            res = cls.rewrite_blocked_hosts(hosts, ts)
+        cls.caches["allowed"].clear()
+        return res
+
+    @classmethod
+    def sync_blocked_hosts(cls, hosts, ts):
+        """Writes only the differences between hosts and the blocked table.
+
+        hosts may be a generator: changed rows are written as they arrive, and
+        stale rows are only deleted once it is exhausted."""
+        current = {
+            item.hash: item.host
+            for item in BlockedHost.scan(attributes_to_get=["hash", "host"])
+        }
+        seen = set()
+        added = 0
+
+        with BatchWriter(BlockedHost, concurrency=WRITE_CONCURRENCY) as batch:
+            for x in hosts:
+                digest = x["digest"]
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                if current.get(digest) != x["domain"]:
+                    batch.save(BlockedHost(digest, host=x["domain"], timestamp=str(ts)))
+                    added += 1
+
+            removed = [d for d in current if d not in seen]
+            for digest in removed:
+                batch.delete(BlockedHost(digest))
+
+        return (added, len(removed))
+
+    @classmethod
+    def rewrite_blocked_hosts(cls, hosts, ts):
+        """Rewrites every blocked host, then deletes the ones not rewritten"""
 
         # First, write/update the new hosts
-        with BlockedHost.batch_write() as batch:
-            items = [
-                BlockedHost(x["digest"], host=x["domain"], timestamp=str(ts))
-                for x in hosts
-            ]
-            for item in items:
-                batch.save(item)
-                # Manual rate limiting. This is dumb, but batch_write() doesn't
-                # support rate-limiting in pynamodb.
-                time.sleep(0.1)
+        written = 0
+        with BatchWriter(BlockedHost, concurrency=WRITE_CONCURRENCY) as batch:
+            for x in hosts:
+                batch.save(
+                    BlockedHost(x["digest"], host=x["domain"], timestamp=str(ts))
+                )
+                written += 1
 
         # Now, query for and delete hosts that didn't get updated
         # Since this involves a scan, it will be expensive.  But, the blocked table
         # is generally pretty small, so I'm not going to worry about it for now.
         cnt = 0
-        for item in BlockedHost.scan(BlockedHost.timestamp != str(ts), rate_limit=1):
-            item.delete()
-            cnt = cnt + 1
+        with BatchWriter(BlockedHost, concurrency=WRITE_CONCURRENCY) as batch:
+            for item in BlockedHost.scan(
+                BlockedHost.timestamp != str(ts), attributes_to_get=["hash"]
+            ):
+                batch.delete(item)
+                cnt = cnt + 1
+
+        return (written, cnt)
 
     @classmethod
     def get_host_config(cls, host):
         """Returns configuration information for the host"""
-        cfg = HostConfig.lookup(host)
+        cfg = cls.cached("hostcfg", host, lambda: HostConfig.lookup(host))
+        if cfg is not None and cfg.client_id is None:
+            # Just a lease: an app is still being registered.
+            cls.caches["hostcfg"].pop(host)
+            return None
         return cfg
 
     @classmethod
@@ -175,4 +528,130 @@ class Datastore:
         """Stores client ID and secret for the given host"""
         cfg = HostConfig(host, client_id=client_id, client_secret=client_secret)
         cfg.save()
+        cls.caches["hostcfg"].pop(host)
         return cfg
+
+    @classmethod
+    def set_host_version(cls, host, version, checked):
+        """Records the probed Mastodon version for the given host"""
+        cfg = HostConfig(host)
+        try:
+            # Only for a registered app, so as not to recreate a row that was
+            # deleted (e.g. to register a new one) as one nobody can lease.
+            cfg.update(
+                actions=[
+                    HostConfig.version.set(version),
+                    HostConfig.version_checked.set(checked),
+                ],
+                condition=HostConfig.client_id.exists(),
+            )
+        except UpdateError as e:
+            if e.cause_response_code != CONDITION_FAILED:
+                raise
+        cls.caches["hostcfg"].pop(host)
+
+
+class AuthSession:
+    """Upkeep of the sessions in the auth table as they are used"""
+
+    @classmethod
+    def renew(cls, authinfo):
+        """Extends a session that is in use, if it is close to expiring.
+        Returns true if the row was rewritten.  Failing to renew doesn't fail
+        the request; the session just expires sooner."""
+        if isinstance(authinfo, sessions.Session):
+            # Can't extend a sealed cookie without issuing a new one.
+            return False
+        if authinfo.expires_at - time.time() > SESSION_RENEW:
+            return False
+        try:
+            # Updating the cached row in place keeps the cache current.
+            authinfo.update(
+                actions=[AuthTable.expires_at.set(get_expire())],
+                condition=AuthTable.key.exists(),
+            )
+        except UpdateError as e:
+            if e.cause_response_code != CONDITION_FAILED:
+                logging.warning("AuthSession.renew: %s", e)
+                return False
+            # Dropped (e.g. logged out) since we read it
+            Datastore.caches["auth"].pop(authinfo.key)
+            return False
+        return True
+
+    @classmethod
+    def set_verified(cls, authinfo, when):
+        """Records when a session was last checked against its server, or
+        clears it (when is None) so that it is checked next time"""
+        if isinstance(authinfo, sessions.Session):
+            # Nowhere to keep it; sealed sessions are checked every time.
+            return
+        action = (
+            AuthTable.verified_at.remove()
+            if when is None
+            else AuthTable.verified_at.set(when)
+        )
+        try:
+            # Updating the cached row in place keeps the cache current.
+            authinfo.update(actions=[action], condition=AuthTable.key.exists())
+        except UpdateError as e:
+            if e.cause_response_code != CONDITION_FAILED:
+                raise
+            # Dropped (e.g. logged out) since we read it
+            Datastore.caches["auth"].pop(authinfo.key)
+
+
+class AppLease:
+    """A lease on a host's HostConfig row, held while our app is registered
+    on the host so that concurrent logins don't each register one"""
+
+    @classmethod
+    def acquire(cls, host, owner, seconds):
+        """Claims the right to register an app on a host for a while.
+        Returns false if someone else holds it, or the app already exists."""
+        now = int(time.time())
+        lease = HostConfig(host, lease_owner=owner, lease_expires=now + seconds)
+        try:
+            lease.save(
+                condition=HostConfig.host.does_not_exist()
+                | (
+                    HostConfig.client_id.does_not_exist()
+                    & (
+                        HostConfig.lease_expires.does_not_exist()
+                        | (HostConfig.lease_expires < now)
+                    )
+                )
+            )
+        except PutError as e:
+            if e.cause_response_code == CONDITION_FAILED:
+                return False
+            raise
+        return True
+
+    @classmethod
+    def release(cls, host, owner):
+        """Gives up a lease, e.g. after failing to register the app"""
+        try:
+            HostConfig(host).delete(
+                condition=(HostConfig.lease_owner == owner)
+                & HostConfig.client_id.does_not_exist()
+            )
+        except DeleteError as e:
+            if e.cause_response_code != CONDITION_FAILED:
+                raise
+
+    @classmethod
+    def wait(cls, host, timeout, interval=0.25, sleep=time.sleep):
+        """Waits for whoever holds the lease on a host to store its config.
+        Returns None if it doesn't appear in time, or the lease lapses."""
+        deadline = time.monotonic() + timeout
+        while True:
+            cfg = HostConfig.lookup(host, consistent_read=True)
+            if cfg is not None and cfg.client_id is not None:
+                Datastore.caches["hostcfg"].set(host, cfg)
+                return cfg
+            if cfg is None or (cfg.lease_expires or 0) < time.time():
+                return None
+            if time.monotonic() >= deadline:
+                return None
+            sleep(interval)
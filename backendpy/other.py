@@ -1,18 +1,153 @@
 """Lambda routines that don't directly process requests"""
 
-import requests
+import codecs
+import json
+import logging
+import os
 import time
-from models import Datastore
+from itertools import islice
+
+import requests
+from models import Datastore, host_digest
+from utils import cleandomains
+
+# Where to get domain blocks from.  Each is a Mastodon domain_blocks
+# endpoint; a comma-separated list may be given, and the lists are merged.
+BLOCKLIST_SOURCES = os.environ.get(
+    "BLOCKLIST_SOURCES", "https://hachyderm.io/api/v1/instance/domain_blocks"
+).split(",")
+
+
+def iter_json_array(chunks):
+    """Yields the elements of a JSON array as its text arrives in chunks"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while pos < len(buf):
+            c = buf[pos]
+            if c.isspace() or (started and c == ","):
+                pos += 1
+            elif not started:
+                if c != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+            elif c == "]":
+                return
+            else:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Most likely an element split across chunks
+                    break
+                if end == len(buf):
+                    # A number, say, could still be continued by the next chunk
+                    break
+                yield obj
+                pos = end
+        buf = buf[pos:]
+    raise ValueError("Truncated JSON array")
+
+
+def open_source(url, validators=None):
+    """Starts a (conditional, if we have validators) streaming GET of a
+    domain_blocks endpoint"""
+    # NOTE: There doesn't seem to be a Mastodon.py method for this.
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    resp = requests.get(url, headers=headers, timeout=60, stream=True)
+    resp.raise_for_status()
+    return resp
+
+
+def validators_of(resp):
+    """Returns the cache validators from a response"""
+    return {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+
+
+def fetch_blocks(resp):
+    """Streams {domain, digest} records from a domain_blocks response"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = (decoder.decode(x) for x in resp.iter_content(chunk_size=16384))
+    for block in iter_json_array(chunks):
+        yield {"domain": block["domain"], "digest": block["digest"]}
+
+
+def clean_blocks(blocks, size=1000):
+    """Normalizes the domains of a stream of records, a chunk at a time"""
+    blocks = iter(blocks)
+    while True:
+        chunk = list(islice(blocks, size))
+        if not chunk:
+            return
+        for block, domain in zip(chunk, cleandomains(b["domain"] for b in chunk)):
+            # Obfuscated domains (e.g. ex*mple.com) are left as published.
+            # Otherwise the digest has to match the name we normalized, as
+            # is_allowed looks hosts (and their parents) up by digest.
+            if "*" not in block["domain"] and domain != block["domain"]:
+                block["domain"] = domain
+                block["digest"] = host_digest(domain)
+            yield block
+
+
+def merged_blocks(responses, seen):
+    """Streams the records from every response, skipping digests already in
+    seen.  seen is updated as we go."""
+    for resp in responses:
+        for block in clean_blocks(fetch_blocks(resp)):
+            if block["digest"] in seen:
+                continue
+            seen.add(block["digest"])
+            yield block
 
 
 def block_update(_event, _context):
     """Pulls a list of hosts to block from github and populates our blocked host
     table"""
 
-    # NOTE: There doesn't seem to be a Mastodon.py method for this.
-    resp = requests.get(
-        "https://hachyderm.io/api/v1/instance/domain_blocks", timeout=60
-    )
-    js = resp.json()
-    ts = int(time.time())
-    Datastore.batch_block_host(js,ts)
+    row = Datastore.get_block_filter_row()
+    known = row.sources.as_dict() if row is not None and row.sources else {}
+
+    responses = {}
+    try:
+        for url in BLOCKLIST_SOURCES:
+            responses[url] = open_source(url, known.get(url))
+
+        # If every source we synced last time says it hasn't changed, there
+        # is nothing to do.
+        unchanged = all(r.status_code == 304 for r in responses.values())
+        if unchanged and set(known) == set(BLOCKLIST_SOURCES):
+            logging.info("block_update: blocklist sources unchanged")
+            # The allow list is edited by hand, so may have changed anyway.
+            Datastore.refresh_block_filter(allowed_only=True)
+            return
+
+        # Otherwise we need every list in full to know what to remove.
+        for url in BLOCKLIST_SOURCES:
+            if responses[url].status_code == 304:
+                responses[url].close()
+                responses[url] = open_source(url)
+        sources = {url: validators_of(r) for (url, r) in responses.items()}
+
+        ts = int(time.time())
+        digests = set()
+        written, deleted = Datastore.batch_block_host(
+            merged_blocks(responses.values(), digests), ts
+        )
+        logging.info("block_update: wrote %d and deleted %d hosts", written, deleted)
+    finally:
+        for resp in responses.values():
+            resp.close()
+
+    # Also picks up changes to the allow list, which is edited by hand.
+    Datastore.refresh_block_filter(digests, ts, sources)
@@ -0,0 +1,201 @@
+"""Message queues with the interface of an SQS client bound to one queue.
+
+SQSQueue talks to a real queue; MemoryQueue and FileQueue stand in for it when
+running locally or in tests."""
+
+# Method and parameter names follow boto3's SQS client.
+# pylint: disable=invalid-name
+
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# How long (in seconds) a received message stays hidden from other receivers
+# before it is delivered again, if it isn't deleted.
+VISIBILITY_TIMEOUT = 300
+
+# The most messages one receive_message call returns.
+MAX_MESSAGES = 10
+
+
+def batch_result(entries, ids):
+    """Builds a send_message_batch response"""
+    return {
+        "Successful": [
+            {"Id": e["Id"], "MessageId": mid} for (e, mid) in zip(entries, ids)
+        ],
+        "Failed": [],
+    }
+
+
+class MemoryQueue:
+    """A queue held in memory, for tests and single-process use"""
+
+    def __init__(self, visibility_timeout=VISIBILITY_TIMEOUT, timer=time.monotonic):
+        self.visibility_timeout = visibility_timeout
+        self.timer = timer
+        self.messages = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def send_message(self, MessageBody):
+        """Adds a message to the queue"""
+        mid = str(uuid.uuid4())
+        with self.lock:
+            self.messages[mid] = MessageBody
+        return {"MessageId": mid}
+
+    def send_message_batch(self, Entries):
+        """Adds several messages to the queue"""
+        ids = [self.send_message(e["MessageBody"])["MessageId"] for e in Entries]
+        return batch_result(Entries, ids)
+
+    def receive_message(self, MaxNumberOfMessages=1, **_kwargs):
+        """Returns up to MaxNumberOfMessages messages, hiding them until they
+        are deleted or their visibility timeout passes"""
+        now = self.timer()
+        res = []
+        with self.lock:
+            for handle, (expires, mid, body) in list(self.inflight.items()):
+                if expires <= now:
+                    del self.inflight[handle]
+                    self.messages[mid] = body
+            while self.messages and len(res) < min(MaxNumberOfMessages, MAX_MESSAGES):
+                mid, body = self.messages.popitem(last=False)
+                handle = str(uuid.uuid4())
+                self.inflight[handle] = (now + self.visibility_timeout, mid, body)
+                res.append({"MessageId": mid, "ReceiptHandle": handle, "Body": body})
+        return {"Messages": res} if res else {}
+
+    def delete_message_batch(self, Entries):
+        """Removes received messages from the queue"""
+        with self.lock:
+            for e in Entries:
+                self.inflight.pop(e["ReceiptHandle"], None)
+        return batch_result(Entries, [e["Id"] for e in Entries])
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages) + len(self.inflight)
+
+
+class FileQueue:
+    """A queue kept as one file per message in a directory, so that several
+    local processes can share it.  Messages are claimed by renaming them into
+    an inflight directory, which is atomic."""
+
+    def __init__(self, directory, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.directory = directory
+        self.inflight_dir = os.path.join(directory, "inflight")
+        self.visibility_timeout = visibility_timeout
+        os.makedirs(self.inflight_dir, exist_ok=True)
+
+    def send_message(self, MessageBody):
+        """Adds a message to the queue"""
+        mid = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+        path = os.path.join(self.directory, f"{mid}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"MessageId": mid, "Body": MessageBody}, f)
+        os.replace(f"{path}.tmp", path)
+        return {"MessageId": mid}
+
+    def send_message_batch(self, Entries):
+        """Adds several messages to the queue"""
+        ids = [self.send_message(e["MessageBody"])["MessageId"] for e in Entries]
+        return batch_result(Entries, ids)
+
+    def requeue_expired(self):
+        """Makes messages whose visibility timeout has passed available again"""
+        cutoff = time.time() - self.visibility_timeout
+        for path in glob.glob(os.path.join(self.inflight_dir, "*.json")):
+            try:
+                if os.path.getmtime(path) <= cutoff:
+                    os.replace(
+                        path, os.path.join(self.directory, os.path.basename(path))
+                    )
+            except OSError:
+                # Deleted or requeued by someone else
+                pass
+
+    def receive_message(self, MaxNumberOfMessages=1, **_kwargs):
+        """Returns up to MaxNumberOfMessages messages, hiding them until they
+        are deleted or their visibility timeout passes"""
+        self.requeue_expired()
+        res = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.json"))):
+            if len(res) >= min(MaxNumberOfMessages, MAX_MESSAGES):
+                break
+            name = os.path.basename(path)
+            claimed = os.path.join(self.inflight_dir, name)
+            try:
+                os.replace(path, claimed)
+                os.utime(claimed)
+                with open(claimed, encoding="utf-8") as f:
+                    msg = json.load(f)
+            except OSError:
+                # Claimed by another receiver first
+                continue
+            res.append({**msg, "ReceiptHandle": name})
+        return {"Messages": res} if res else {}
+
+    def delete_message_batch(self, Entries):
+        """Removes received messages from the queue"""
+        for e in Entries:
+            name = os.path.basename(e["ReceiptHandle"])
+            try:
+                os.remove(os.path.join(self.inflight_dir, name))
+            except FileNotFoundError:
+                pass
+        return batch_result(Entries, [e["Id"] for e in Entries])
+
+
+class SQSQueue:
+    """An Amazon SQS queue"""
+
+    def __init__(self, url, client=None):
+        self.url = url
+        if client is None:
+            # boto3 is provided by the Lambda runtime
+            import boto3  # pylint: disable=import-outside-toplevel,import-error
+
+            client = boto3.client("sqs")
+        self.client = client
+
+    def send_message(self, MessageBody):
+        """Adds a message to the queue"""
+        return self.client.send_message(QueueUrl=self.url, MessageBody=MessageBody)
+
+    def send_message_batch(self, Entries):
+        """Adds several messages to the queue"""
+        return self.client.send_message_batch(QueueUrl=self.url, Entries=Entries)
+
+    def receive_message(self, MaxNumberOfMessages=1, **kwargs):
+        """Returns up to MaxNumberOfMessages messages"""
+        return self.client.receive_message(
+            QueueUrl=self.url, MaxNumberOfMessages=MaxNumberOfMessages, **kwargs
+        )
+
+    def delete_message_batch(self, Entries):
+        """Removes received messages from the queue"""
+        return self.client.delete_message_batch(QueueUrl=self.url, Entries=Entries)
+
+
+# Memory queues by name, so that a handler and worker in one process share
+# them.
+memory_queues = {}
+
+
+def open_queue(url):
+    """Returns the queue for a URL: memory://name, file:///path, or an SQS
+    queue URL.  Returns None for an empty URL."""
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return memory_queues.setdefault(url, MemoryQueue())
+    if url.startswith("file://"):
+        return FileQueue(url[len("file://") :])
+    return SQSQueue(url)
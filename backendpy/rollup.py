@@ -0,0 +1,256 @@
+"""Rolls telemetry events up into compact columnar files for offline queries.
+
+Events are read from log exports or NDJSON files (as written by
+telemetry.log_events, or one event per line), grouped by time bucket, event
+type and domain, and saved with one array per column:
+
+    python backendpy/rollup.py build telemetry.tlr logs/*.txt
+    python backendpy/rollup.py query telemetry.tlr --by type --start 1700000000
+"""
+
+import argparse
+import json
+import math
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+from columnar import ColumnFile
+
+# Default size of a time bucket, in seconds.
+BUCKET = 3600
+
+# Columns in file order.  Rows are sorted by (bucket, type, domain).
+COLUMNS = (
+    ("bucket", "q"),
+    ("type", "i"),
+    ("domain", "i"),
+    ("count", "q"),
+    ("timed", "q"),
+    ("total_ms", "d"),
+    ("min_ms", "d"),
+    ("max_ms", "d"),
+)
+
+# The timestamp at the start of a Lambda log line
+LOG_TS_RE = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z?")
+
+decoder = json.JSONDecoder()
+
+
+def line_time(prefix):
+    """Returns the timestamp in the text before a logged record, or None"""
+    m = LOG_TS_RE.search(prefix)
+    if m is None:
+        return None
+    text = m.group(0).rstrip("Z")
+    return int(datetime.fromisoformat(text + "+00:00").timestamp())
+
+
+def read_events(lines):
+    """Yields (timestamp, event) for every telemetry event in some lines of
+    log or NDJSON text"""
+    for line in lines:
+        start = line.find("{")
+        if start < 0:
+            continue
+        try:
+            obj, _ = decoder.raw_decode(line, start)
+        except ValueError:
+            continue
+        if not isinstance(obj, dict):
+            continue
+        ts = obj.get("ts")
+        if ts is None:
+            ts = line_time(line[:start])
+        events = obj["telemetry"] if isinstance(obj.get("telemetry"), list) else [obj]
+        for event in events:
+            if isinstance(event, dict):
+                yield (event.get("ts", ts) or 0, event)
+
+
+def event_domain(event):
+    """Returns the domain an event came from, if we can tell"""
+    domain = event.get("domain")
+    if domain is None:
+        domain = str(event.get("acct", "")).rpartition("@")[2]
+    return str(domain).lower()
+
+
+class StringTable:
+    """Assigns small integer ids to strings"""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def id(self, value):
+        """Returns the id for a string, adding it if needed"""
+        res = self.ids.get(value)
+        if res is None:
+            res = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return res
+
+
+class Rollup(ColumnFile):
+    """Rolled-up telemetry held in parallel column arrays, which may be
+    memoryviews of an mmapped file"""
+
+    MAGIC = b"TLROLL02"
+    TYPECODES = tuple(code for (_, code) in COLUMNS)
+
+    def __init__(self, columns, types, domains, bucket=BUCKET, buf=None):
+        self.columns = dict(zip((name for (name, _) in COLUMNS), columns))
+        self.types = types
+        self.domains = domains
+        self.bucket = bucket
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.columns["bucket"])
+
+    @classmethod
+    def build(cls, events, bucket=BUCKET):
+        """Rolls up (timestamp, event) pairs"""
+        types, domains = (StringTable(), StringTable())
+
+        # Dictionary-encode the grouping columns first, so that grouping is
+        # on one packed integer per event rather than on strings.
+        keys = []
+        elapsed = array("d")
+        for ts, event in events:
+            type_id = types.id(str(event.get("action", event.get("type", ""))))
+            domain_id = domains.id(event_domain(event))
+            keys.append((int(ts) // bucket) << 40 | type_id << 20 | domain_id)
+            ms = event.get("elapsed_ms")
+            elapsed.append(float(ms) if isinstance(ms, (int, float)) else float("nan"))
+        if len(types.strings) >= 1 << 20 or len(domains.strings) >= 1 << 20:
+            raise ValueError("Too many distinct types or domains")
+
+        groups = {}
+        for key, ms in zip(keys, elapsed):
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, 0, 0.0, float("inf"), float("-inf")]
+            group[0] += 1
+            if not math.isnan(ms):
+                group[1] += 1
+                group[2] += ms
+                group[3] = min(group[3], ms)
+                group[4] = max(group[4], ms)
+
+        columns = tuple(array(code) for (_, code) in COLUMNS)
+        for key in sorted(groups):
+            count, timed, total, low, high = groups[key]
+            row = (
+                (key >> 40) * bucket,
+                key >> 20 & 0xFFFFF,
+                key & 0xFFFFF,
+                count,
+                timed,
+                total,
+                low if timed else 0.0,
+                high if timed else 0.0,
+            )
+            for column, value in zip(columns, row):
+                column.append(value)
+        return cls(columns, types.strings, domains.strings, bucket)
+
+    def rows(self, type_=None, domain=None, start=None, end=None):
+        """Yields the rows matching some filters as dicts.  start and end
+        are timestamps, and select the buckets that start in [start, end)."""
+        cols = self.columns
+        lo = 0 if start is None else bisect_left(cols["bucket"], start)
+        hi = len(self) if end is None else bisect_left(cols["bucket"], end)
+        type_id = self.types.index(type_) if type_ in self.types else -1
+        domain_id = self.domains.index(domain) if domain in self.domains else -1
+        if (type_ is not None and type_id < 0) or (
+            domain is not None and domain_id < 0
+        ):
+            return
+        for i in range(lo, hi):
+            if type_ is not None and cols["type"][i] != type_id:
+                continue
+            if domain is not None and cols["domain"][i] != domain_id:
+                continue
+            row = {name: cols[name][i] for (name, _) in COLUMNS}
+            row["type"] = self.types[row["type"]]
+            row["domain"] = self.domains[row["domain"]]
+            yield row
+
+    def totals(self, by="type", **filters):
+        """Sums the matching rows, grouped by one column"""
+        res = {}
+        for row in self.rows(**filters):
+            total = res.setdefault(
+                row[by], {"count": 0, "timed": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            total["count"] += row["count"]
+            total["timed"] += row["timed"]
+            total["total_ms"] += row["total_ms"]
+            total["max_ms"] = max(total["max_ms"], row["max_ms"])
+        for total in res.values():
+            total["mean_ms"] = (
+                total["total_ms"] / total["timed"] if total["timed"] else None
+            )
+        return res
+
+    def parts(self):
+        """Returns the columns and string tables to save"""
+        columns = [self.columns[name] for (name, _) in COLUMNS]
+        strings = {"types": self.types, "domains": self.domains, "bucket": self.bucket}
+        return (columns, strings)
+
+    @classmethod
+    def from_parts(cls, columns, strings, buf):
+        """Builds a rollup from a loaded file"""
+        return cls(
+            columns, strings["types"], strings["domains"], strings["bucket"], buf=buf
+        )
+
+
+def read_files(paths):
+    """Yields (timestamp, event) from some files, or stdin for -"""
+    for path in paths:
+        if path == "-":
+            yield from read_events(sys.stdin)
+            continue
+        with open(path, encoding="utf-8", errors="replace") as f:
+            yield from read_events(f)
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="roll up event files")
+    build.add_argument("output")
+    build.add_argument("inputs", nargs="+")
+    build.add_argument("--bucket", type=int, default=BUCKET)
+    query = commands.add_parser("query", help="summarize a rollup file")
+    query.add_argument("rollup")
+    query.add_argument("--by", choices=["type", "domain", "bucket"], default="type")
+    query.add_argument("--type", dest="type_")
+    query.add_argument("--domain")
+    query.add_argument("--start", type=int)
+    query.add_argument("--end", type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        rollup = Rollup.build(read_files(args.inputs), args.bucket)
+        rollup.save(args.output)
+        print(f"rollup: wrote {len(rollup)} rows to {args.output}")
+        return
+
+    rollup = Rollup.load(args.rollup)
+    filters = {k: getattr(args, k) for k in ("type_", "domain", "start", "end")}
+    totals = rollup.totals(by=args.by, **filters)
+    for key in sorted(totals, key=str):
+        print(json.dumps({args.by: key, **totals[key]}))
+
+
+if __name__ == "__main__":
+    main()
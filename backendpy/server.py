@@ -2,16 +2,13 @@
 
 import json
 import logging
-import uuid
-
-from mastodon import (
-    MastodonAPIError,
-)
 
 from factory import MastodonFactory
 from models import Datastore
 from shared import callback_helper
-from utils import response, err_response
+from utils import lazy_import, response, err_response
+
+mastodonpy = lazy_import("mastodon")
 
 # AWS doens't set a logging level, so set it here.
 logging.getLogger("root").setLevel(logging.INFO)
@@ -33,9 +30,7 @@ def callback(event, context):
         params = event.get("queryStringParameters", {}) or {}
         domain = params.get("domain", "UNKNOWN")
 
-        cookie = uuid.uuid4().urn
-
-        Datastore.set_auth(cookie, token=token, domain=domain)
+        cookie = Datastore.new_session(token=token, domain=domain)
 
         return {"statusCode": 200, "body": json.dumps({"status": "OK", "auth": cookie})}
 
@@ -51,10 +46,11 @@ def logout(event, _):
     try:
         mastodon = MastodonFactory.from_cookie(cookie)
         mastodon.revoke_access_token()
+        MastodonFactory.evict(mastodon)
 
         # Dump the cookie
         Datastore.drop_auth(cookie)
-    except MastodonAPIError as e:
+    except mastodonpy.MastodonAPIError as e:
         logging.error("ERROR - other API error: %s", str(e))
         return err_response("ERROR - API error")
 
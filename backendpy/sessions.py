@@ -0,0 +1,123 @@
+"""Stateless session cookies, as an alternative to the auth table.
+
+A sealed cookie carries the session's domain, token and expiry encrypted and
+authenticated under one of our keys with AES-GCM, so it can be opened without
+a table read:
+
+    s1.<key id>.<base64url(nonce | ciphertext | tag)>
+
+The "s1.<key id>." header is bound to the ciphertext as associated data.
+packages/server/sessions.ts opens the same cookies for the node handlers.
+"""
+
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+
+# Keys as "id:base64url key" pairs, separated by commas.  Each key is 16, 24
+# or 32 bytes.  New cookies are sealed with the first; the others are only
+# used to open existing cookies, so a key can be rotated out once cookies
+# sealed with it have expired.  Stateless sessions are off unless some key is
+# set.
+SESSION_KEYS = os.environ.get("SESSION_KEYS", "")
+
+# Marks a sealed cookie (table cookies are uuid URNs)
+PREFIX = "s1"
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def parse_keys(spec):
+    """Parses SESSION_KEYS into a list of (id, key)"""
+    parsed = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        kid, _, secret = item.strip().partition(":")
+        key = base64.urlsafe_b64decode(secret + "=" * (-len(secret) % 4))
+        if not kid or "." in kid or len(key) not in (16, 24, 32):
+            raise ValueError(f"Bad session key {kid!r}")
+        parsed.append((kid, key))
+    return parsed
+
+
+keys = parse_keys(SESSION_KEYS)
+
+
+def enabled():
+    """Returns true if new sessions should be sealed cookies"""
+    return len(keys) > 0
+
+
+def is_sealed(cookie):
+    """Returns true if a cookie is (or claims to be) a sealed one"""
+    return cookie is not None and cookie.startswith(PREFIX + ".")
+
+
+def cipher(key):
+    """Returns an AES-GCM cipher for a key"""
+    # Only handlers that see sealed cookies pay for importing cryptography.
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    return AESGCM(key)
+
+
+class Session:
+    """The contents of a sealed cookie.  Has the attributes of an AuthTable
+    row that the handlers use."""
+
+    def __init__(self, key, token, domain, expires_at, jti):
+        self.key = key
+        self.token = token
+        self.domain = domain
+        self.expires_at = expires_at
+        self.jti = jti
+        # Sealed sessions aren't marked verified, see AuthSession.set_verified.
+        self.verified_at = None
+
+
+def seal(domain, token, expires_at):
+    """Returns a sealed cookie for a session"""
+    kid, key = keys[0]
+    payload = json.dumps(
+        {"d": domain, "t": token, "e": int(expires_at), "j": uuid.uuid4().hex}
+    ).encode("utf-8")
+    nonce = os.urandom(NONCE_SIZE)
+    header = f"{PREFIX}.{kid}.".encode("ascii")
+    sealed = cipher(key).encrypt(nonce, payload, header)
+    body = base64.urlsafe_b64encode(nonce + sealed).rstrip(b"=")
+    return (header + body).decode("ascii")
+
+
+def open_cookie(cookie):
+    """Returns the Session in a sealed cookie, or None if it is forged,
+    sealed with a key we no longer have, or expired.  Revocation is checked
+    by the caller, see Datastore.get_auth."""
+    try:
+        prefix, kid, body = cookie.split(".")
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+    except ValueError:
+        return None
+    key = next((k for (i, k) in keys if i == kid), None)
+    if prefix != PREFIX or key is None or len(raw) < NONCE_SIZE + TAG_SIZE:
+        return None
+
+    # pylint: disable=import-outside-toplevel
+    from cryptography.exceptions import InvalidTag
+
+    header = f"{PREFIX}.{kid}.".encode("ascii")
+    try:
+        payload = cipher(key).decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], header)
+    except InvalidTag:
+        logging.warning("sessions: bad tag on cookie for key %s", kid)
+        return None
+
+    data = json.loads(payload)
+    if data["e"] <= time.time():
+        return None
+    return Session(cookie, data["t"], data["d"], data["e"], data["j"])
@@ -3,19 +3,17 @@
 import json
 import logging
 import os
-import requests
+import threading
+import time
+import uuid
 
-from mastodon import (
-    Mastodon,
-    MastodonAPIError,
-    MastodonIllegalArgumentError,
-    MastodonNetworkError,
-)
+from pynamodb.exceptions import PynamoDBException
 
 from factory import MastodonFactory, NoAuthInfo, NotMastodon, USER_AGENT
-from models import Datastore
+from models import AppLease, AuthSession, Datastore
 from utils import (
     get_cookie,
+    lazy_import,
     response,
     cleandomain,
     blocked_response,
@@ -23,6 +21,29 @@ from utils import (
     badhost_response,
 )
 
+# Only loaded by the paths that talk to a Mastodon server.
+mastodonpy = lazy_import("mastodon")
+requests = lazy_import("requests")
+
+# How long (in seconds) one invocation may spend registering an app on a host
+# before others stop waiting for it, and how long they wait.
+APP_LEASE = int(os.environ.get("APP_LEASE", "30"))
+APP_WAIT = float(os.environ.get("APP_WAIT", "10"))
+
+# Registrations within this process are serialized per host on these, so
+# concurrent requests don't even need the table lease to agree.
+app_locks = [threading.Lock() for _ in range(64)]
+
+# A session checked against its server this recently (in seconds) is taken
+# as still logged in by auth, without asking the server again.
+VERIFY_FRESH = int(os.environ.get("VERIFY_FRESH", "300"))
+
+
+class AppBusy(Exception):
+    """Internal exception for when another invocation is still registering
+    our app on a host"""
+
+
 # The list of scopes that we need for our app
 # NOTE: If this of scopes changes, you'll have to remove items in the
 # hostsCfg table to allow them to be recreated.
@@ -37,7 +58,7 @@ def make_app(domain, redirect_url):
     # correct header
     s = requests.Session()
     s.headers.update({"User-Agent": USER_AGENT})
-    (client_id, client_secret) = Mastodon.create_app(
+    (client_id, client_secret) = mastodonpy.Mastodon.create_app(
         "Mastodon List Manager",
         scopes=SCOPES,
         redirect_uris=redirect_url,
@@ -47,6 +68,105 @@ def make_app(domain, redirect_url):
     return (client_id, client_secret)
 
 
+def register_app(domain, redirect_url):
+    """Returns the config for a host, registering our app on it first if
+    needed.  Only one invocation at a time registers an app on a given host;
+    the others wait for and reuse its result, or raise AppBusy if it takes
+    too long."""
+    with app_locks[hash(domain) % len(app_locks)]:
+        cfg = Datastore.get_host_config(domain)
+        if cfg is not None:
+            return cfg
+
+        owner = uuid.uuid4().hex
+        unleased = False
+        try:
+            leased = AppLease.acquire(domain, owner, APP_LEASE)
+        except PynamoDBException as e:
+            # Fall back to the local lock alone.
+            logging.warning("register_app: no lease for %s: %s", domain, e)
+            leased, unleased = (False, True)
+
+        if not leased and not unleased:
+            cfg = AppLease.wait(domain, APP_WAIT)
+            if cfg is not None:
+                return cfg
+            # Only register the app ourselves if whoever had the lease has
+            # given it up (or let it lapse).  Otherwise they may still be
+            # registering one.
+            try:
+                leased = AppLease.acquire(domain, owner, APP_LEASE)
+            except PynamoDBException as e:
+                # Someone else held the lease, so it isn't safe to fall back
+                # to the local lock now.
+                logging.warning("register_app: no lease for %s: %s", domain, e)
+                raise AppBusy(domain) from e
+            if not leased:
+                raise AppBusy(domain)
+
+        logging.debug("auth: making app for %s", domain)
+        try:
+            (client_id, client_secret) = make_app(domain, redirect_url)
+        except Exception:
+            if leased:
+                release_app_lease(domain, owner)
+            raise
+        logging.debug("auth: Made the app!")
+        return Datastore.set_host_config(
+            domain, client_id=client_id, client_secret=client_secret
+        )
+
+
+def release_app_lease(domain, owner):
+    """Gives up our lease on a host after failing to register an app, without
+    hiding the error that made us fail"""
+    try:
+        AppLease.release(domain, owner)
+    except PynamoDBException as e:
+        logging.warning("register_app: couldn't release lease on %s: %s", domain, e)
+
+
+def recently_verified(authinfo):
+    """Returns true if a session was checked against its server recently"""
+    verified = authinfo.verified_at
+    return verified is not None and time.time() - verified < VERIFY_FRESH
+
+
+def mark_verified(authinfo, when):
+    """Records (or clears) when a session was checked, without failing the
+    request if we can't"""
+    try:
+        AuthSession.set_verified(authinfo, when)
+    except PynamoDBException as e:
+        logging.warning("auth: couldn't record verification: %s", e)
+
+
+def logged_in_response(cookie, authinfo):
+    """Returns the response for a cookie with a live session, or None if we
+    need to start the oAuth flow"""
+    if authinfo is not None and recently_verified(authinfo):
+        AuthSession.renew(authinfo)
+        logging.info("Already logged in (recently verified)")
+        return {"statusCode": 200, "body": json.dumps({"status": "OK"})}
+    try:
+        test = MastodonFactory.from_cookie(cookie)
+        test.me()
+        if authinfo is not None:
+            mark_verified(authinfo, int(time.time()))
+        logging.info("Already logged in")
+        return {"statusCode": 200, "body": json.dumps({"status": "OK"})}
+    except mastodonpy.MastodonAPIError:
+        # If here, we aren't logged in, so drop through to start the oAuth
+        # flow.  Make sure the session is checked again next time.
+        if authinfo is not None and authinfo.verified_at is not None:
+            mark_verified(authinfo, None)
+    except NoAuthInfo:
+        # If here, we didn't get a mastodon instance back, so start the
+        # oAuth flow
+        pass
+    return None
+
+
 def make_redirect_url(_, domain):
     """Create a redirect URL based on the origin of the request"""
     redirect_base = os.environ.get("AUTH_REDIRECT", "http://localhost:3000")
@@ -66,6 +186,7 @@ def auth(event, _):
     domain = cleandomain(rawdomain)
 
     # Ignore the cookie if it belongs to some other domain
+    authinfo = None
     if cookie is not None:
         authinfo = Datastore.get_auth(cookie)
         if authinfo is not None:
@@ -75,19 +196,9 @@ def auth(event, _):
                 cookie = None
 
     if cookie is not None:
-        try:
-            test = MastodonFactory.from_cookie(cookie)
-            test.me()
-            logging.info("Already logged in")
-            return {"statusCode": 200, "body": json.dumps({"status": "OK"})}
-        except MastodonAPIError:
-            # If here, we aren't logged in, so drop through to start the
-            # oAuth flow.
-            pass
-        except NoAuthInfo:
-            # If here, we didn't get a mastodon instance back, so start the
-            # oAuth flow
-            pass
+        res = logged_in_response(cookie, authinfo)
+        if res is not None:
+            return res
 
     # If we don't have a domain here, then we have to bail
     if domain is None or domain == "":
@@ -109,20 +220,19 @@ def auth(event, _):
 
     if cfg is None:
         # Make an app
-        logging.debug("auth: making app for %s", domain)
         try:
-            (client_id, client_secret) = make_app(domain, redirect_url)
-            logging.debug("auth: Made the app!")
-        except MastodonNetworkError as e:
+            cfg = register_app(domain, redirect_url)
+        except mastodonpy.MastodonNetworkError as e:
             # Log what the user typed with the error.
             print("mastodon network error")
             print(e)
             print(redirect_url)
             return badhost_response(rawdomain)
-
-        cfg = Datastore.set_host_config(
-            domain, client_id=client_id, client_secret=client_secret
-        )
+        except AppBusy:
+            # Someone else is part way through registering it, so try again
+            # shortly.
+            logging.warning("auth: app registration busy for %s", domain)
+            return response(json.dumps({"status": "busy"}), statusCode=503)
 
     logging.debug("creating from config")
     try:
@@ -158,7 +268,7 @@ def callback_helper(event, _, finish):
         logging.error("Domain is %s", domain)
         return err_response("ERROR - no host config")
 
-    mastodon = Mastodon(
+    mastodon = mastodonpy.Mastodon(
         client_id=cfg.client_id,
         client_secret=cfg.client_secret,
         user_agent=USER_AGENT,
@@ -175,7 +285,7 @@ def callback_helper(event, _, finish):
             redirect_uri=redirect_url,
             scopes=SCOPES,
         )
-    except MastodonIllegalArgumentError:
+    except mastodonpy.MastodonIllegalArgumentError:
         logging.error(
             "MastodonIllegalArgumentError, code = %s, redirect_uri = %s, domain = %s",
             code,
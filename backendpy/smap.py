@@ -1,37 +1,388 @@
 """Source mapping for JS"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
 import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import requests
 import sourcemap
+from sourcemap.objects import Token
 
-cachedurls = {}
+from columnar import ColumnFile
 
+# Parsed maps are kept in memory up to roughly this many bytes of index.
+CACHE_BYTES = int(os.environ.get("SMAP_CACHE_BYTES", str(64 * 1024 * 1024)))
 
-def get_info(url, lineno, column):
-    """Gets info about a particular URL in a stack trace"""
-    if url not in cachedurls:
-        cachedurls[url] = requests.get(url, timeout=10).text
-    js = cachedurls[url]
+# If set (e.g. /tmp/smap), parsed maps are also saved to this directory, so
+# that maps evicted from memory don't have to be fetched and parsed again.
+CACHE_DIR = os.environ.get("SMAP_CACHE_DIR", "")
+
+# Maps precomputed at deploy time (see build_store) are shipped here, one
+# index per bundle file.  Bundle names carry a content hash, so a name always
+# identifies one build of a bundle.
+LOCAL_DIR = os.environ.get(
+    "SMAP_LOCAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "smaps")
+)
+BUNDLE_RE = re.compile(r"^\w[\w.-]*\.js$")
+
+# Base64 digit values for VLQ decoding
+B64_DIGITS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+B64 = {c: i for (i, c) in enumerate(B64_DIGITS)}
+
+
+def parse_vlq(segment):
+    """Decodes one source map segment into a list of integers"""
+    values = []
+    cur, shift = 0, 0
+    for c in segment:
+        val = B64[c]
+        cur += (val & 0b11111) << shift
+        shift += 5
+        if not val & 0b100000:
+            values.append(-(cur >> 1) if cur & 1 else cur >> 1)
+            cur, shift = 0, 0
+    if shift:
+        raise ValueError(f"Truncated VLQ segment {segment}")
+    return values
+
+
+class CompactIndex(ColumnFile):  # pylint: disable=too-many-instance-attributes
+    """A source map index held in parallel arrays rather than an object per
+    token.  Generated positions are packed into one sorted 64-bit key per
+    token (line << 32 | column), original positions live in arrays at the
+    same offsets, and sources and names are string tables.
+
+    The arrays may be memoryviews of an mmapped index file."""
+
+    MAGIC = b"SMIDX001"
+    TYPECODES = ("q", "i", "i", "i", "i")
+
+    def __init__(self, columns, sources, names, buf=None):
+        self.keys, self.src_ids, self.src_lines, self.src_cols, self.name_ids = columns
+        self.sources = sources
+        self.names = names
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the columns"""
+        return len(self.keys) * 24
+
+    @classmethod
+    def from_json(cls, text):
+        """Decodes source map JSON straight into a CompactIndex"""
+        # A map may be prefixed with a line starting )]}' to prevent XSSI.
+        if text.startswith(")]}"):
+            text = text.split("\n", 1)[1]
+        smap = json.loads(text)
+        sources = smap["sources"]
+        if smap.get("sourceRoot") is not None:
+            sources = [os.path.join(smap["sourceRoot"], x) for x in sources]
+        names = [str(x) for x in smap["names"]]
+
+        columns = (array("q"), array("i"), array("i"), array("i"), array("i"))
+        keys, src_ids, src_lines, src_cols, name_ids = columns
+        src_id, src_line, src_col, name_id = (0, 0, 0, 0)
+        for dst_line, line in enumerate(smap["mappings"].split(";")):
+            dst_col = 0
+            for segment in line.split(","):
+                if not segment:
+                    continue
+                parse = parse_vlq(segment)
+                dst_col += parse[0]
+                keys.append(dst_line << 32 | dst_col)
+                if len(parse) > 1:
+                    src_id += parse[1]
+                    src_line += parse[2]
+                    src_col += parse[3]
+                    src_ids.append(src_id)
+                    src_lines.append(src_line)
+                    src_cols.append(src_col)
+                else:
+                    src_ids.append(-1)
+                    src_lines.append(0)
+                    src_cols.append(0)
+                if len(parse) > 4:
+                    name_id += parse[4]
+                    name_ids.append(name_id)
+                else:
+                    name_ids.append(-1)
+
+        # Columns are almost always emitted in order, but make sure.  The sort
+        # is stable, so like sourcemap.loads the last of any duplicate
+        # positions wins a lookup.
+        if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            columns = tuple(array(c.typecode, (c[i] for i in order)) for c in columns)
+        return cls(columns, sources, names)
+
+    def lookup(self, line, column):
+        """Returns the Token for a generated position, like
+        sourcemap.SourceMapIndex.lookup"""
+        i = bisect_right(self.keys, line << 32 | column) - 1
+        if i < 0 or self.keys[i] >> 32 != line:
+            raise IndexError
+        src_id = self.src_ids[i]
+        name_id = self.name_ids[i]
+        return Token(
+            dst_line=line,
+            dst_col=self.keys[i] & 0xFFFFFFFF,
+            src=self.sources[src_id] if src_id >= 0 else None,
+            src_line=self.src_lines[i],
+            src_col=self.src_cols[i],
+            name=self.names[name_id] if name_id >= 0 else None,
+        )
+
+    def parts(self):
+        """Returns the columns and string tables to save"""
+        columns = (
+            self.keys,
+            self.src_ids,
+            self.src_lines,
+            self.src_cols,
+            self.name_ids,
+        )
+        return (columns, {"sources": self.sources, "names": self.names})
+
+    @classmethod
+    def from_parts(cls, columns, strings, buf):
+        """Builds an index from a loaded file"""
+        return cls(columns, strings["sources"], strings["names"], buf=buf)
+
+
+class IndexCache:
+    """An LRU cache of CompactIndex objects per bundle URL, bounded by their
+    size"""
+
+    def __init__(self, maxbytes, directory=""):
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, url):
+        """Returns the file a parsed map for url is saved to"""
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.smidx")
+
+    def get(self, url):
+        """Returns the parsed index for a bundle, or None"""
+        with self._lock:
+            if url in self._data:
+                self._data.move_to_end(url)
+                return self._data[url][0]
+        if not self.directory:
+            return None
+        try:
+            index = CompactIndex.load(self.path(url))
+        except (OSError, ValueError):
+            return None
+        self.put(url, index, index.nbytes, persist=False)
+        return index
+
+    def put(self, url, index, size, persist=True):
+        """Stores the parsed index for a bundle"""
+        with self._lock:
+            if url in self._data:
+                self.size -= self._data.pop(url)[1]
+            self._data[url] = (index, size)
+            self.size += size
+            while self.size > self.maxbytes and len(self._data) > 1:
+                self.size -= self._data.popitem(last=False)[1][1]
+        if persist and self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                index.save(self.path(url))
+            except OSError as e:
+                logging.warning("smap: could not save map for %s: %s", url, e)
+
+    def clear(self):
+        """Empties the in-memory cache"""
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+index_cache = IndexCache(CACHE_BYTES, CACHE_DIR)
+
+# Bundles and maps are fetched in parallel over one keep-alive session, and
+# we give up on any that aren't back within the deadline (in seconds).
+FETCH_WORKERS = 8
+DEADLINE = float(os.environ.get("SMAP_DEADLINE", "20"))
+session = requests.Session()
+
+FRAME_RE = re.compile(r"(http[s]?://[^/]+[^:]*):(\d+):(\d+)")
+
+
+def bundle_name(url):
+    """Returns the file name of a bundle URL, or None if it doesn't look like
+    one of ours"""
+    name = url.split("?", 1)[0].split("#", 1)[0].rsplit("/", 1)[-1]
+    return name if BUNDLE_RE.match(name) else None
+
+
+def local_index(url):
+    """Returns the precomputed index shipped for a bundle, or None"""
+    name = bundle_name(url)
+    if name is None or not LOCAL_DIR:
+        return None
+    try:
+        return CompactIndex.load(os.path.join(LOCAL_DIR, f"{name}.smidx"))
+    except (OSError, ValueError):
+        return None
+
+
+def cached_index(url):
+    """Returns the index for a bundle if we have it without fetching"""
+    index = index_cache.get(url)
+    if index is None:
+        index = local_index(url)
+        if index is not None:
+            index_cache.put(url, index, index.nbytes, persist=False)
+    return index
+
+
+def load_index(url):
+    """Returns the parsed source map for a JS bundle, fetching it if needed"""
+    index = cached_index(url)
+    if index is not None:
+        return index
+    js = session.get(url, timeout=10).text
     path = sourcemap.discover(js)
     parts = url.split("/")
     urlbase = "/".join(parts[0 : len(parts) - 1])
     mapurl = urlbase + "/" + path
-    if mapurl not in cachedurls:
-        cachedurls[mapurl] = requests.get(mapurl, timeout=10).text
-    smap = cachedurls[mapurl]
-    index = sourcemap.loads(smap)
+    index = CompactIndex.from_json(session.get(mapurl, timeout=10).text)
+    index_cache.put(url, index, index.nbytes)
+    return index
+
+
+def load_indexes(urls, deadline):
+    """Returns a dict of url -> parsed map for every bundle we could load
+    within the deadline"""
+    res = {}
+    missing = []
+    for url in urls:
+        index = cached_index(url)
+        if index is None:
+            missing.append(url)
+        else:
+            res[url] = index
+    if not missing:
+        return res
+
+    pool = ThreadPoolExecutor(min(len(missing), FETCH_WORKERS))
+    futures = {pool.submit(load_index, url): url for url in missing}
+    done, pending = wait(futures, timeout=deadline)
+    # Anything still running is left to finish (and fill the cache) in the
+    # background.
+    pool.shutdown(wait=False, cancel_futures=True)
+    for future in done:
+        try:
+            res[futures[future]] = future.result()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.warning("smap: could not load map for %s: %s", futures[future], e)
+    for future in pending:
+        logging.warning("smap: timed out loading map for %s", futures[future])
+    return res
+
+
+def describe(index, lineno, column):
+    """Describes the original source location for a generated position"""
     token = index.lookup(line=lineno, column=column)
     return f"{token} ({token.src}:{token.src_line})"
 
 
-def map_stacktrace(txt):
-    """Parses a string stacktrace, returning an array of mapped frames in the trace."""
-    res = []
+def get_info(url, lineno, column):
+    """Gets info about a particular URL in a stack trace"""
+    return describe(load_index(url), lineno, column)
+
+
+def parse_frames(txt):
+    """Returns (raw line, url, line, column) for each frame of a stacktrace"""
+    frames = []
     for line in txt.split("\n"):
-        m = re.search(r"(http[s]?://[^/]+[^:]*):(\d+):(\d+)", line)
+        m = FRAME_RE.search(line)
         if m is not None:
-            url = m.group(1)
-            lineno = int(m.group(2)) - 1
-            column = int(m.group(3))
-            res.append(get_info(url, lineno, column))
+            frames.append(
+                (line.strip(), m.group(1), int(m.group(2)) - 1, int(m.group(3)))
+            )
+    return frames
+
+
+def map_stacktraces(txts, deadline=DEADLINE):
+    """Maps several stacktraces at once, loading each bundle's map once and
+    within one overall deadline.  Returns a list of mapped frames per trace."""
+    parsed = [parse_frames(txt) for txt in txts]
+    urls = {url for frames in parsed for (_, url, _, _) in frames}
+    indexes = load_indexes(urls, deadline)
+
+    res = []
+    for frames in parsed:
+        mapped = []
+        for raw, url, lineno, column in frames:
+            try:
+                mapped.append(describe(indexes[url], lineno, column))
+            except (KeyError, IndexError):
+                mapped.append(raw)
+        res.append(mapped)
     return res
+
+
+def map_stacktrace(txt, deadline=DEADLINE):
+    """Parses a string stacktrace, returning an array of mapped frames in the
+    trace.  Frames we can't map in time are returned as they were."""
+    return map_stacktraces([txt], deadline)[0]
+
+
+def have_maps(txt):
+    """Returns true if the map for every bundle in a stacktrace is loaded, so
+    that mapping it again wouldn't map any more of it"""
+    return all(cached_index(url) is not None for (_, url, _, _) in parse_frames(txt))
+
+
+def build_store(srcdir, outdir):
+    """Precomputes an index for every bundle in a build directory that has a
+    source map, replacing whatever was in outdir.  Returns the bundle names."""
+    os.makedirs(outdir, exist_ok=True)
+    for path in glob.glob(os.path.join(outdir, "*.smidx")):
+        os.remove(path)
+    names = []
+    for path in sorted(glob.glob(os.path.join(srcdir, "*.js"))):
+        name = os.path.basename(path)
+        with open(path, encoding="utf-8") as f:
+            mapfile = sourcemap.discover(f.read())
+        if not BUNDLE_RE.match(name) or mapfile is None or "://" in mapfile:
+            continue
+        with open(os.path.join(srcdir, mapfile), encoding="utf-8") as f:
+            index = CompactIndex.from_json(f.read())
+        index.save(os.path.join(outdir, f"{name}.smidx"))
+        names.append(name)
+    return names
+
+
+def main():
+    """Command line entry point for build_store"""
+    parser = argparse.ArgumentParser(description="Precompute JS source maps")
+    parser.add_argument("srcdir", help="directory of built JS bundles")
+    parser.add_argument("outdir", nargs="?", default=LOCAL_DIR)
+    args = parser.parse_args()
+    for name in build_store(args.srcdir, args.outdir):
+        print(f"smap: indexed {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,67 @@
 """Telemetry functions for Mastodon List Manager"""
 
+import base64
+import hashlib
 import json
 import logging
+import os
+import re
+import threading
+import time
+import zlib
 
-from smap import map_stacktrace
+from cache import MISSING, TTLCache
+from queues import MAX_MESSAGES, open_queue
+from utils import lazy_import, response
+
+# The source map stack (requests, sourcemap) is only loaded once there is a
+# stack to map.
+smap = lazy_import("smap")
 
 # AWS doens't set a logging level, so set it here.
 logging.getLogger("root").setLevel(logging.INFO)
 # But don't log much from botocore
 logging.getLogger("botocore").setLevel(logging.ERROR)
 
+# If set, error reports are queued here and symbolicated in batches by
+# error_worker, rather than before the error handler returns.  See
+# queues.open_queue for the URLs understood.
+ERROR_QUEUE = os.environ.get("ERROR_QUEUE", "")
+error_queue = open_queue(ERROR_QUEUE)
+
+# Repeats of an error are counted per fingerprint, and the counts (with a
+# sample report) are logged at most this often (in seconds).  The first
+# report with a given fingerprint is logged in full straight away, and again
+# once SEEN_TTL has passed.
+FLUSH_INTERVAL = int(os.environ.get("ERROR_FLUSH_INTERVAL", "60"))
+SEEN_TTL = int(os.environ.get("ERROR_SEEN_TTL", "3600"))
+# Stacks that couldn't be fully mapped (say, a map didn't load in time) are
+# only remembered this long (in seconds) before we try them again.
+RETRY_TTL = int(os.environ.get("ERROR_RETRY_TTL", "60"))
+
+# How many frames from the top of the stack identify an error.
+TOP_FRAMES = 5
+
+# Mapped frames per raw stack, so that repeats aren't symbolicated again.
+mapped_stacks = TTLCache(maxsize=1024, ttl=SEEN_TTL)
+
+# Strips what varies between occurrences of the same error: numbers in
+# messages, and query strings and line numbers in frames.
+NUMBER_RE = re.compile(r"\d+")
+FRAME_NOISE_RE = re.compile(r"\?[^:)\s]*|(:\d+)+\)?$")
+
+# Limits on one telemetry request: decompressed size, and number of events.
+MAX_BODY = 1024 * 1024
+MAX_EVENTS = 1000
+
+# Accepted events are logged as JSON records of up to about this many bytes
+# (CloudWatch truncates log events at 256KB).
+MAX_RECORD = 200 * 1024
+
+# When draining the queue ourselves, stop while this much time (in ms) is
+# left in the invocation.
+DRAIN_RESERVE_MS = 5000
+
 
 def ok_response():
     """Return an OK response"""
@@ -19,21 +71,240 @@ def ok_response():
     }
 
 
+def read_body(event):
+    """Returns the text of a request body, decoding base64 and gzip"""
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    headers = {k.lower(): v for (k, v) in (event.get("headers") or {}).items()}
+    if headers.get("content-encoding") == "gzip" or body[:2] == b"\x1f\x8b":
+        decoder = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            body = decoder.decompress(body, MAX_BODY + 1)
+        except zlib.error as e:
+            raise ValueError("Bad gzip body") from e
+    if len(body) > MAX_BODY:
+        raise ValueError("Body too large")
+    return body.decode("utf-8")
+
+
+def parse_events(text):
+    """Parses a telemetry body: a JSON object, a JSON array of them, or
+    newline-delimited JSON objects"""
+    try:
+        events = json.loads(text)
+    except ValueError:
+        # Not one JSON value, so it had better be one per line.
+        events = [json.loads(x) for x in text.split("\n") if x.strip()]
+    else:
+        if not isinstance(events, list):
+            events = [events]
+    if len(events) > MAX_EVENTS:
+        raise ValueError("Too many events")
+    return events
+
+
+def log_events(events, rejected):
+    """Logs accepted events as a few large JSON records rather than a line
+    each.  Records carry the time they were received, for rollup.py."""
+    ts = int(time.time())
+    parts = [json.dumps(x) for x in events]
+    start, size = (0, 0)
+    for i, part in enumerate(parts):
+        if size + len(part) > MAX_RECORD and i > start:
+            logging.info('{"ts": %d, "telemetry": [%s]}', ts, ", ".join(parts[start:i]))
+            start, size = (i, 0)
+        size += len(part) + 2
+    if start < len(parts):
+        logging.info('{"ts": %d, "telemetry": [%s]}', ts, ", ".join(parts[start:]))
+    if rejected:
+        logging.warning("telemetry: rejected %d events", rejected)
+
+
 def telemetry(event, _):
-    """Log a telemetry event"""
+    """Log a batch of telemetry events"""
+    try:
+        events = parse_events(read_body(event))
+    except ValueError as e:
+        return response(json.dumps({"status": str(e)}), statusCode=400)
 
-    # Basically log everything that we got.
-    logging.info(event["body"])
-    return ok_response()
+    accepted = [x for x in events if isinstance(x, dict)]
+    rejected = len(events) - len(accepted)
+    if rejected and not accepted:
+        return response(json.dumps({"status": "No valid events"}), statusCode=400)
+    log_events(accepted, rejected)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {"status": "OK", "accepted": len(accepted), "rejected": rejected}
+        ),
+    }
 
 
-def error(event, _):
-    """Log an error event"""
-    # Basically log everything that we got.
-    data = json.loads(event["body"])
-    if "stack" in data:
-        frames = map_stacktrace(data["stack"])
+def parse_report(body):
+    """Parses and checks an error report, raising ValueError if it is bad"""
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("Error report is not an object")
+    if not isinstance(data.get("stack", ""), str):
+        raise ValueError("Error report stack is not a string")
+    return data
+
+
+def stack_fingerprint(stack):
+    """Returns a key that is the same for identical raw stacks"""
+    lines = [x.strip() for x in stack.split("\n")]
+    return hashlib.sha256("\n".join(x for x in lines if x).encode()).hexdigest()
+
+
+def error_fingerprint(data, frames):
+    """Returns a key that is the same for reports of the same error: its
+    normalized message and top mapped frames"""
+    message = NUMBER_RE.sub("N", str(data.get("message", "")))
+    top = [FRAME_NOISE_RE.sub("", x) for x in frames[:TOP_FRAMES]]
+    key = "\n".join([message] + top)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class ErrorAggregator:
+    """Counts reports per error fingerprint between periodic flushes"""
+
+    def __init__(self, interval=FLUSH_INTERVAL, seen_ttl=SEEN_TTL, timer=time.time):
+        self.interval = interval
+        self.timer = timer
+        self.seen = TTLCache(maxsize=4096, ttl=seen_ttl, timer=timer)
+        self.counts = {}
+        self.last_flush = timer()
+        self.lock = threading.Lock()
+
+    def add(self, fingerprint, data):
+        """Records a report, returning True if it is the first with its
+        fingerprint in a while and should be logged in full"""
+        with self.lock:
+            if self.seen.get(fingerprint) is MISSING:
+                self.seen.set(fingerprint, True)
+                return True
+            count, first, _ = self.counts.get(fingerprint, (0, self.timer(), None))
+            self.counts[fingerprint] = (count + 1, first, data)
+            return False
+
+    def flush(self, force=False):
+        """Logs the counts since the last flush, if one is due"""
+        with self.lock:
+            now = self.timer()
+            if not force and now - self.last_flush < self.interval:
+                return
+            counts, self.counts = (self.counts, {})
+            self.last_flush = now
+        for fingerprint, (count, first, sample) in counts.items():
+            logging.error(
+                json.dumps(
+                    {
+                        "fingerprint": fingerprint,
+                        "count": count,
+                        "first_seen": first,
+                        "last_flush": now,
+                        "sample": sample,
+                    }
+                )
+            )
+
+
+aggregator = ErrorAggregator()
+
+
+def symbolicate(reports):
+    """Maps the stacks of several reports in place, mapping each distinct
+    stack once and skipping stacks we mapped recently.  Returns the mapped
+    frames for each report."""
+    keys = [stack_fingerprint(x["stack"]) if x.get("stack") else None for x in reports]
+    mapped, todo = ({}, {})
+    for key, data in zip(keys, reports):
+        if key is None or key in mapped or key in todo:
+            continue
+        frames = mapped_stacks.get(key)
+        if frames is MISSING:
+            todo[key] = data["stack"]
+        else:
+            mapped[key] = frames
+    if todo:
+        for key, frames in zip(todo, smap.map_stacktraces(todo.values())):
+            ttl = None if smap.have_maps(todo[key]) else RETRY_TTL
+            mapped_stacks.set(key, frames, ttl)
+            mapped[key] = frames
+
+    res = []
+    for key, data in zip(keys, reports):
+        frames = mapped.get(key, [])
         if len(frames) > 0:
             data["stack"] = "\n".join(frames)
-    logging.error(json.dumps(data))
+        res.append(frames)
+    return res
+
+
+def log_reports(reports):
+    """Symbolicates a batch of error reports, logging those that are new and
+    counting the rest"""
+    for data, frames in zip(reports, symbolicate(reports)):
+        fingerprint = error_fingerprint(data, frames)
+        if aggregator.add(fingerprint, data):
+            logging.error(json.dumps({**data, "fingerprint": fingerprint}))
+    aggregator.flush()
+
+
+def error(event, _):
+    """Log an error event"""
+    try:
+        data = parse_report(event["body"])
+    except ValueError as e:
+        return response(json.dumps({"status": str(e)}), statusCode=400)
+
+    if error_queue is not None:
+        error_queue.send_message(MessageBody=json.dumps(data))
+    else:
+        log_reports([data])
     return ok_response()
+
+
+def parse_messages(bodies):
+    """Returns the reports from queued message bodies, dropping bad ones"""
+    reports = []
+    for body in bodies:
+        try:
+            reports.append(parse_report(body))
+        except ValueError as e:
+            logging.warning("error_worker: dropping bad report: %s", e)
+    return reports
+
+
+def error_worker(event, context):
+    """Symbolicates and logs queued error reports in batches.
+
+    When triggered by SQS, the batch arrives in the event.  Otherwise (e.g. on
+    a schedule, or with a local queue) we drain the queue ourselves.  Repeat
+    counts are logged after every batch, as there may be no later report to
+    flush them before the container is recycled."""
+    if "Records" in event:
+        log_reports(parse_messages(r["body"] for r in event["Records"]))
+        aggregator.flush(force=True)
+        return
+
+    while error_queue is not None:
+        if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+            if context.get_remaining_time_in_millis() < DRAIN_RESERVE_MS:
+                break
+        messages = error_queue.receive_message(MaxNumberOfMessages=MAX_MESSAGES).get(
+            "Messages", []
+        )
+        if not messages:
+            break
+        log_reports(parse_messages(m["Body"] for m in messages))
+        aggregator.flush(force=True)
+        error_queue.delete_message_batch(
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]}
+                for (i, m) in enumerate(messages)
+            ]
+        )
@@ -0,0 +1,49 @@
+"""Tests for in-process caches"""
+
+from unittest import TestCase
+from cache import MISSING, TTLCache
+
+
+class FakeTimer:
+    """A controllable clock"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(TestCase):
+    """Tests for TTLCache"""
+
+    def test_get_set(self):
+        """Values can be stored and retrieved, including None"""
+        cache = TTLCache()
+        cache.set("a", 1)
+        cache.set("b", None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertIs(cache.get("c"), MISSING)
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 2})
+
+    def test_expiry(self):
+        """Entries expire after their TTL"""
+        timer = FakeTimer()
+        cache = TTLCache(ttl=10, timer=timer)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=100)
+        timer.now = 11
+        self.assertIs(cache.get("a"), MISSING)
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when full"""
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(len(cache), 2)
@@ -1,16 +1,37 @@
 """Tests for Datastore interface"""
 
-from unittest.mock import patch
+import time
+from unittest.mock import MagicMock, patch
 from unittest import TestCase
-from models import Datastore
+from pynamodb.exceptions import PutError, UpdateError
+import models
+from models import (
+    AppLease,
+    AuthSession,
+    Datastore,
+    HostConfig,
+    HostFilter,
+    digests_hash,
+    host_digest,
+    host_suffixes,
+)
 
 
 class TestDatastore(TestCase):
     """Tests for MastodonFactory methods"""
 
+    def setUp(self):
+        Datastore.clear_caches()
+        # By default, behave as if no block filter has been published.
+        patcher = patch("models.BlockFilter")
+        self.filtermock = patcher.start()
+        self.filtermock.lookup.return_value = None
+        self.addCleanup(patcher.stop)
+
     @patch("models.AuthTable")
     def test_getauth(self, authmock):
         """Test for Datastore.get_auth"""
+        authmock.lookup.return_value.expires_at = time.time() + 3600
 
         Datastore.get_auth("cookie")
         authmock.lookup.assert_called_with("cookie")
@@ -22,6 +43,15 @@ class TestDatastore(TestCase):
         Datastore.get_host_config("host")
         hostmock.lookup.assert_called_with("host")
 
+    @patch("models.AuthTable")
+    def test_getauth_expired(self, authmock):
+        """get_auth ignores rows that have expired but not been deleted yet"""
+        authmock.lookup.return_value.expires_at = time.time() - 1
+
+        self.assertIsNone(Datastore.get_auth("cookie"))
+        self.assertIsNone(Datastore.get_auth("cookie"))
+        self.assertEqual(authmock.lookup.call_count, 2)
+
     @patch("models.AllowedHost")
     def test_allowed(self, allowmock):
         """Test for allowed hosts"""
@@ -53,3 +83,381 @@ class TestDatastore(TestCase):
             "4740ae6347b0172c01254ff55bae5aff5199f4446e7f6d643d40185b3f475145"
         )
         self.assertTrue(res)
+
+    @patch("models.AuthTable")
+    def test_getauth_cached(self, authmock):
+        """Repeated get_auth calls are served from the cache"""
+        authmock.lookup.return_value.expires_at = time.time() + 3600
+
+        Datastore.get_auth("cookie")
+        Datastore.get_auth("cookie")
+        self.assertEqual(authmock.lookup.call_count, 1)
+
+    @patch("models.AuthTable")
+    def test_setauth_invalidates(self, authmock):
+        """set_auth and drop_auth invalidate the cached auth row"""
+        authmock.lookup.return_value.expires_at = time.time() + 3600
+
+        Datastore.get_auth("cookie")
+        Datastore.set_auth("cookie", "token", "domain")
+        Datastore.get_auth("cookie")
+        self.assertEqual(authmock.lookup.call_count, 2)
+        Datastore.drop_auth("cookie")
+        Datastore.get_auth("cookie")
+        self.assertEqual(authmock.lookup.call_count, 3)
+
+    @patch("models.HostConfig")
+    def test_sethostconfig_invalidates(self, hostmock):
+        """set_host_config invalidates the cached host config"""
+
+        Datastore.get_host_config("host")
+        Datastore.get_host_config("host")
+        Datastore.set_host_config("host", "id", "secret")
+        Datastore.get_host_config("host")
+        self.assertEqual(hostmock.lookup.call_count, 2)
+
+    @patch.object(HostConfig, "update")
+    def test_sethostversion_deleted(self, updatemock):
+        """set_host_version doesn't recreate a deleted host config"""
+        cause = MagicMock()
+        cause.response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+        updatemock.side_effect = UpdateError(cause=cause)
+        Datastore.set_host_version("host", "4.0.0", 1234)
+        self.assertIsNotNone(updatemock.call_args.kwargs["condition"])
+
+        updatemock.side_effect = UpdateError()
+        with self.assertRaises(UpdateError):
+            Datastore.set_host_version("host", "4.0.0", 1234)
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_blockhost_invalidates(self, blockmock, allowmock):
+        """Blocking hosts invalidates cached is_allowed results"""
+        allowmock.lookup.return_value = None
+        blockmock.lookup.return_value = None
+        self.assertTrue(Datastore.is_allowed("host"))
+        self.assertTrue(Datastore.is_allowed("host"))
+        self.assertEqual(blockmock.lookup.call_count, 1)
+
+        blockmock.lookup.return_value = "blocked"
+        Datastore.block_host("sha", "host")
+        self.assertFalse(Datastore.is_allowed("host"))
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_parent_blocked_no_filter(self, blockmock, allowmock):
+        """Without a filter, every suffix is checked in one batch read"""
+        allowmock.lookup.return_value = None
+        blockmock.lookup_many.return_value = {host_digest("bad.example"): "row"}
+        self.assertFalse(Datastore.is_allowed("a.bad.example"))
+        (digests,) = blockmock.lookup_many.call_args[0]
+        self.assertEqual(
+            digests, [host_digest("a.bad.example"), host_digest("bad.example")]
+        )
+
+    def test_host_suffixes(self):
+        """Suffixes stop short of the TLD"""
+        self.assertEqual(host_suffixes("a.b.c"), ["a.b.c", "b.c"])
+        self.assertEqual(host_suffixes("b.c"), ["b.c"])
+        self.assertEqual(host_suffixes("host"), ["host"])
+
+    @patch("models.BatchWriter")
+    @patch("models.BlockedHost")
+    def test_sync_blocked_hosts(self, blockmock, writermock):
+        """Incremental sync only writes changed rows and deletes stale ones"""
+
+        def row(digest, host):
+            item = MagicMock()
+            item.hash = digest
+            item.host = host
+            return item
+
+        blockmock.scan.return_value = [
+            row("same", "same.host"),
+            row("renamed", "old.host"),
+            row("stale", "stale.host"),
+        ]
+        hosts = [
+            {"digest": "same", "domain": "same.host"},
+            {"digest": "renamed", "domain": "new.host"},
+            {"digest": "new", "domain": "new.host"},
+        ]
+        res = Datastore.batch_block_host(hosts, 1234)
+
+        self.assertEqual(res, (2, 1))
+        saved = {c.args[0] for c in blockmock.call_args_list if "host" in c.kwargs}
+        self.assertEqual(saved, {"renamed", "new"})
+        blockmock.assert_any_call("stale")
+        self.assertIs(writermock.call_args.args[0], blockmock)
+        batch = writermock.return_value.__enter__.return_value
+        self.assertEqual(batch.save.call_count, 2)
+        self.assertEqual(batch.delete.call_count, 1)
+
+    @patch("models.BatchWriter")
+    @patch("models.BlockedHost")
+    def test_rewrite_blocked_hosts(self, blockmock, writermock):
+        """A full rewrite saves every host and batch-deletes stale rows"""
+        blockmock.scan.return_value = [MagicMock(), MagicMock()]
+        hosts = [{"digest": "a", "domain": "a.host"}]
+        res = Datastore.batch_block_host(hosts, 1234, incremental=False)
+
+        self.assertEqual(res, (1, 2))
+        batch = writermock.return_value.__enter__.return_value
+        self.assertEqual(batch.save.call_count, 1)
+        self.assertEqual(batch.delete.call_count, 2)
+
+
+class TestBlockFilter(TestCase):
+    """Tests for the published block filter"""
+
+    def setUp(self):
+        Datastore.clear_caches()
+        patcher = patch("models.BlockFilter")
+        self.filtermock = patcher.start()
+        self.filtermock.lookup.return_value = None
+        self.addCleanup(patcher.stop)
+
+    def set_filter(self, blocked, allowed=None):
+        """Publishes a block filter for the given blocked digests"""
+        row = MagicMock()
+        row.digests = HostFilter.pack(blocked)
+        row.allowed = allowed
+        self.filtermock.lookup.return_value = row
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_filter_parent_blocked(self, blockmock, allowmock):
+        """Subdomains of a blocked domain are blocked, with one table lookup"""
+        self.set_filter([host_digest("bad.example")])
+        allowmock.lookup.return_value = None
+        self.assertFalse(Datastore.is_allowed("a.b.Bad.Example"))
+        blockmock.lookup.assert_called_once_with(host_digest("bad.example"))
+        self.assertTrue(Datastore.is_allowed("notbad.example"))
+        self.assertTrue(Datastore.is_allowed("bad.example.org"))
+        self.assertEqual(blockmock.lookup.call_count, 1)
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_filter_miss(self, blockmock, allowmock):
+        """Hosts not in the block filter are allowed without a table lookup"""
+        self.set_filter(["00" * 32])
+        self.assertTrue(Datastore.is_allowed("host"))
+        allowmock.lookup.assert_not_called()
+        blockmock.lookup.assert_not_called()
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_filter_hit(self, blockmock, allowmock):
+        """Hosts in the block filter are confirmed against the tables"""
+        sha = "4740ae6347b0172c01254ff55bae5aff5199f4446e7f6d643d40185b3f475145"
+        self.set_filter([sha])
+        allowmock.lookup.return_value = None
+        self.assertFalse(Datastore.is_allowed("host"))
+        blockmock.lookup.assert_called_with(sha)
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_filter_allowed(self, blockmock, allowmock):
+        """Hosts on the published allowlist skip the tables"""
+        sha = "4740ae6347b0172c01254ff55bae5aff5199f4446e7f6d643d40185b3f475145"
+        self.set_filter([sha], allowed={"host"})
+        self.assertTrue(Datastore.is_allowed("host"))
+        allowmock.lookup.assert_not_called()
+        blockmock.lookup.assert_not_called()
+
+    @patch("models.AllowedHost")
+    def test_publish_filter(self, allowmock):
+        """publish_block_filter stores packed digest prefixes and allowed hosts"""
+        allowed = MagicMock()
+        allowed.host = "ok"
+        allowmock.scan.return_value = [allowed]
+        Datastore.publish_block_filter({"ff" * 32, "01" * 32}, 1234)
+        self.filtermock.assert_called_with(
+            "blocked",
+            digests=b"\x01" * 8 + b"\xff" * 8,
+            allowed={"ok"},
+            timestamp=1234,
+            sources=None,
+            content_hash=digests_hash({"ff" * 32, "01" * 32}),
+        )
+        self.assertTrue(self.filtermock.return_value.save.called)
+
+    def published_row(self, digests, allowed):
+        """Makes the published filter row have some contents"""
+        row = MagicMock()
+        row.content_hash = digests_hash(digests)
+        row.allowed = allowed
+        row.timestamp = 1234
+        row.sources = None
+        self.filtermock.lookup.return_value = row
+        return row
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_blockhost_republishes(self, blockmock, allowmock):
+        """block_host adds the host to a published filter"""
+        self.published_row({"01" * 32}, None)
+        allowmock.scan.return_value = []
+        blockmock.scan.return_value = [MagicMock(hash=x * 32) for x in ("01", "ff")]
+        Datastore.block_host("ff" * 32, "host")
+        kwargs = self.filtermock.call_args.kwargs
+        self.assertEqual(kwargs["digests"], b"\x01" * 8 + b"\xff" * 8)
+        self.assertEqual(kwargs["timestamp"], 1234)
+        self.assertTrue(self.filtermock.return_value.save.called)
+
+    @patch("models.AllowedHost")
+    def test_refresh_filter(self, allowmock):
+        """The filter is republished when the allow list changes, even if the
+        blocklist hasn't"""
+        self.published_row({"01" * 32}, {"gone"})
+        allowmock.scan.return_value = []
+        self.assertTrue(Datastore.refresh_block_filter({"01" * 32}, 5678, {}))
+        self.assertEqual(self.filtermock.call_args.kwargs["allowed"], None)
+
+        self.published_row({"01" * 32}, None)
+        self.filtermock.reset_mock(return_value=False)
+        self.assertFalse(Datastore.refresh_block_filter({"01" * 32}, 5678, {}))
+        self.assertFalse(self.filtermock.return_value.save.called)
+        self.filtermock.return_value.update.assert_called_once()
+
+    @patch("models.AllowedHost")
+    @patch("models.BlockedHost")
+    def test_refresh_filter_allowed_only(self, blockmock, allowmock):
+        """An allow list check only scans the blocked table if the allow
+        list has changed"""
+        self.published_row({"01" * 32}, {"gone", "kept"})
+        allowmock.scan.return_value = [MagicMock(host="kept")]
+        blockmock.scan.return_value = [MagicMock(hash="01" * 32)]
+        self.assertTrue(Datastore.refresh_block_filter(allowed_only=True))
+        self.assertEqual(self.filtermock.call_args.kwargs["allowed"], {"kept"})
+        self.assertEqual(self.filtermock.call_args.kwargs["timestamp"], 1234)
+
+        self.published_row({"01" * 32}, {"kept"})
+        blockmock.reset_mock()
+        self.assertFalse(Datastore.refresh_block_filter(allowed_only=True))
+        blockmock.scan.assert_not_called()
+
+
+class TestAuthSession(TestCase):
+    """Tests for keeping auth table sessions up to date"""
+
+    def setUp(self):
+        Datastore.clear_caches()
+
+    @patch("models.AuthTable")
+    def test_renew(self, authmock):
+        """AuthSession.renew only rewrites sessions that are close to expiring"""
+        authinfo = MagicMock()
+        authinfo.expires_at = time.time() + models.SESSION_RENEW + 60
+        self.assertFalse(AuthSession.renew(authinfo))
+        authinfo.update.assert_not_called()
+
+        authinfo.expires_at = time.time() + models.SESSION_RENEW - 60
+        self.assertTrue(AuthSession.renew(authinfo))
+        authinfo.update.assert_called_once()
+        (expires,) = authmock.expires_at.set.call_args.args
+        self.assertGreaterEqual(expires, time.time() + models.SESSION_TTL - 1)
+
+    @patch("models.AuthTable")
+    def test_set_verified(self, authmock):
+        """AuthSession.set_verified updates the cached row in place"""
+        authmock.lookup.return_value.expires_at = time.time() + 3600
+        row = authmock.lookup.return_value
+        authinfo = Datastore.get_auth("cookie")
+        AuthSession.set_verified(authinfo, 100)
+        row.update.assert_called_once()
+        authmock.verified_at.set.assert_called_with(100)
+        self.assertIs(Datastore.get_auth("cookie"), row)
+        AuthSession.set_verified(authinfo, None)
+        authmock.verified_at.remove.assert_called_with()
+        self.assertEqual(authmock.lookup.call_count, 1)
+
+
+class TestAppLease(TestCase):
+    """Tests for the lease taken while registering an app on a host"""
+
+    def setUp(self):
+        Datastore.clear_caches()
+
+    @patch.object(HostConfig, "save")
+    def test_acquire(self, savemock):
+        """AppLease.acquire claims the host with a conditional write"""
+        self.assertTrue(AppLease.acquire("host", "me", 30))
+        # A row without a lease (say, one only holding a version) is free
+        condition = str(savemock.call_args.kwargs["condition"])
+        self.assertIn("attribute_not_exists (lease_expires)", condition)
+
+    @patch.object(HostConfig, "save")
+    def test_acquire_held(self, savemock):
+        """AppLease.acquire returns False when the condition fails"""
+        cause = MagicMock()
+        cause.response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+        savemock.side_effect = PutError(cause=cause)
+        self.assertFalse(AppLease.acquire("host", "me", 30))
+
+    @patch.object(HostConfig, "save", side_effect=PutError())
+    def test_acquire_error(self, _savemock):
+        """Other write errors are raised"""
+        with self.assertRaises(PutError):
+            AppLease.acquire("host", "me", 30)
+
+    @patch("models.HostConfig")
+    def test_lease_not_config(self, hostmock):
+        """A lease row isn't a host config, and isn't cached"""
+        hostmock.lookup.return_value = MagicMock(client_id=None)
+        self.assertIsNone(Datastore.get_host_config("host"))
+        self.assertIsNone(Datastore.get_host_config("host"))
+        self.assertEqual(hostmock.lookup.call_count, 2)
+
+    @patch("models.HostConfig")
+    def test_wait(self, hostmock):
+        """AppLease.wait polls until the config is stored"""
+        lease = MagicMock(client_id=None, lease_expires=2**40)
+        cfg = MagicMock(client_id="id")
+        hostmock.lookup.side_effect = [lease, lease, cfg]
+        sleep = MagicMock()
+        self.assertIs(AppLease.wait("host", 10, sleep=sleep), cfg)
+        self.assertEqual(sleep.call_count, 2)
+        hostmock.lookup.assert_called_with("host", consistent_read=True)
+        # And the result is cached for later requests
+        self.assertIs(Datastore.get_host_config("host"), cfg)
+        self.assertEqual(hostmock.lookup.call_count, 3)
+
+    @patch("models.HostConfig")
+    def test_wait_lapsed(self, hostmock):
+        """AppLease.wait gives up when the lease lapses"""
+        hostmock.lookup.return_value = MagicMock(client_id=None, lease_expires=0)
+        sleep = MagicMock()
+        self.assertIsNone(AppLease.wait("host", 10, sleep=sleep))
+        self.assertFalse(sleep.called)
+
+
+class TestMyModel(TestCase):
+    """Tests for MyModel lookups"""
+
+    @patch.object(HostConfig, "get")
+    def test_lookup(self, getmock):
+        """lookup uses GetItem and passes through consistency and projection"""
+        getmock.return_value = "cfg"
+        res = HostConfig.lookup(
+            "host", consistent_read=True, attributes_to_get=["host"]
+        )
+        getmock.assert_called_with(
+            "host", consistent_read=True, attributes_to_get=["host"]
+        )
+        self.assertEqual(res, "cfg")
+
+    @patch.object(HostConfig, "get", side_effect=HostConfig.DoesNotExist)
+    def test_lookup_missing(self, _getmock):
+        """lookup returns None for missing keys"""
+        self.assertIsNone(HostConfig.lookup("host"))
+
+    @patch.object(HostConfig, "batch_get")
+    def test_lookup_many(self, batchmock):
+        """lookup_many returns found items keyed by hash key"""
+        item = MagicMock()
+        item.host = "a"
+        batchmock.return_value = iter([item])
+        res = HostConfig.lookup_many(["a", "b", "a"])
+        self.assertEqual(batchmock.call_args.args[0], {"a", "b"})
+        self.assertEqual(res, {"a": item})
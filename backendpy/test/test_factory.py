@@ -1,9 +1,11 @@
 """Tests for Mastodon factory"""
 
 import logging
-from unittest.mock import MagicMock, patch, sentinel
+import time
+from unittest.mock import ANY, MagicMock, patch, sentinel
 from unittest import TestCase
-from factory import MastodonFactory, USER_AGENT
+import factory
+from factory import MastodonFactory, NotMastodon, USER_AGENT
 
 # Here, reconfigure the logger to send output to a file during tests.
 logging.basicConfig(level=logging.INFO, filename="debug_log.txt")
@@ -15,13 +17,19 @@ def mock_hostconfig():
     cfg.client_id = sentinel.client_id
     cfg.client_secret = sentinel.client_secret
     cfg.host = sentinel.host
+    cfg.version = None
+    cfg.version_checked = None
     return cfg
 
 
 class TestFactory(TestCase):
     """Tests for MastodonFactory methods"""
 
-    @patch("factory.Mastodon")
+    def setUp(self):
+        factory.version_cache.clear()
+        factory.client_pool.clear()
+
+    @patch("factory.mastodonpy.Mastodon")
     def test_fromconfig_notoken(self, mastomock):
         """Test for MastodonFactory.from_config without a token"""
 
@@ -34,9 +42,11 @@ class TestFactory(TestCase):
             access_token=None,
             user_agent=USER_AGENT,
             api_base_url=f"https://{sentinel.host}",
+            mastodon_version=None,
+            session=ANY,
         )
 
-    @patch("factory.Mastodon")
+    @patch("factory.mastodonpy.Mastodon")
     def test_fromconfig_withtoken(self, mastomock):
         """Test for MastodonFactory.from_config with a token"""
 
@@ -49,11 +59,87 @@ class TestFactory(TestCase):
             access_token=sentinel.token,
             user_agent=USER_AGENT,
             api_base_url=f"https://{sentinel.host}",
+            mastodon_version=None,
+            session=ANY,
         )
 
+    @patch("factory.mastodonpy.Mastodon")
+    def test_fromconfig_cached_version(self, mastomock):
+        """A second from_config for a host reuses the probed version"""
+
+        mastomock.return_value.version_check_worked = True
+        mastomock.return_value.mastodon_major = 4
+        mastomock.return_value.mastodon_minor = 2
+        mastomock.return_value.mastodon_patch = 1
+
+        cfg = mock_hostconfig()
+        MastodonFactory.from_config(cfg)
+        MastodonFactory.from_config(cfg, token=sentinel.token)
+
+        self.assertEqual(mastomock.call_args.kwargs["mastodon_version"], "4.2.1")
+
+    @patch("factory.mastodonpy.Mastodon")
+    def test_fromconfig_stored_version(self, mastomock):
+        """A fresh version stored with the HostConfig skips the probe"""
+
+        cfg = mock_hostconfig()
+        cfg.version = "4.1.0"
+        cfg.version_checked = time.time()
+        MastodonFactory.from_config(cfg)
+
+        self.assertEqual(mastomock.call_args.kwargs["mastodon_version"], "4.1.0")
+
+    @patch("factory.mastodonpy.Mastodon")
+    def test_fromconfig_notmastodon_cached(self, mastomock):
+        """Hosts that fail the version check are not probed again"""
+
+        mastomock.return_value.version_check_worked = False
+
+        cfg = mock_hostconfig()
+        with self.assertRaises(NotMastodon):
+            MastodonFactory.from_config(cfg)
+        with self.assertRaises(NotMastodon):
+            MastodonFactory.from_config(cfg)
+
+        self.assertEqual(mastomock.call_count, 1)
+
+    @patch("factory.mastodonpy.Mastodon")
+    def test_fromconfig_pooled(self, mastomock):
+        """Clients are reused per (host, token) and share a session per host"""
+
+        cfg = mock_hostconfig()
+        cfg.version = "4.1.0"
+        cfg.version_checked = time.time()
+        first = MastodonFactory.from_config(cfg, token=sentinel.token)
+        second = MastodonFactory.from_config(cfg, token=sentinel.token)
+        MastodonFactory.from_config(cfg, token=sentinel.other)
+
+        self.assertIs(first, second)
+        self.assertEqual(mastomock.call_count, 2)
+        sessions = [c.kwargs["session"] for c in mastomock.call_args_list]
+        self.assertIs(sessions[0], sessions[1])
+        self.assertEqual(MastodonFactory.pool_stats()["hits"], 1)
+
+    @patch("factory.mastodonpy.Mastodon")
+    def test_evict(self, mastomock):
+        """Evicted clients are rebuilt on the next request"""
+
+        cfg = mock_hostconfig()
+        cfg.version = "4.1.0"
+        cfg.version_checked = time.time()
+        client = MastodonFactory.from_config(cfg, token=sentinel.token)
+        client.api_base_url = f"https://{sentinel.host}"
+        client.client_id = sentinel.client_id
+        client.access_token = sentinel.token
+        MastodonFactory.evict(client)
+        MastodonFactory.from_config(cfg, token=sentinel.token)
+
+        self.assertEqual(mastomock.call_count, 2)
+
+    @patch("factory.AuthSession")
     @patch("factory.Datastore")
     @patch("factory.MastodonFactory.from_config")
-    def test_fromcookie(self, from_config, data_store):
+    def test_fromcookie(self, from_config, data_store, session):
         """Test for MastodonFactory.from_config with a token"""
 
         auth = MagicMock()
@@ -67,3 +153,4 @@ class TestFactory(TestCase):
 
         data_store.get_host_config.assert_called_with(sentinel.domain)
         from_config.assert_called_with(sentinel.host_config, token=sentinel.token)
+        session.renew.assert_called_with(auth)
@@ -0,0 +1,124 @@
+"""Tests for the blocklist update routines"""
+
+import json
+from unittest.mock import MagicMock, patch
+from unittest import TestCase
+import other
+
+
+def chunked(txt, size):
+    """Splits txt into chunks of the given size"""
+    return [txt[i : i + size] for i in range(0, len(txt), size)]
+
+
+def mock_blocks(*domains):
+    """Returns domain_blocks records for the given domains"""
+    return [
+        {"domain": d, "digest": f"sha-{d}", "severity": "suspend", "comment": "x"}
+        for d in domains
+    ]
+
+
+def mock_response(status, body=b"", headers=None):
+    """Returns a mock streaming requests response"""
+    resp = MagicMock()
+    resp.status_code = status
+    resp.headers = headers or {}
+    resp.iter_content.return_value = chunked(body, 5)
+    return resp
+
+
+class TestBlockUpdate(TestCase):
+    """Tests for block_update and its helpers"""
+
+    def test_iter_json_array(self):
+        """Array elements are parsed no matter how the text is chunked"""
+        data = [{"a": 1, "b": "x,]"}, {"a": 22}, 3, [4, 5]]
+        txt = " " + json.dumps(data) + "\n"
+        for size in (1, 2, 7, len(txt)):
+            res = list(other.iter_json_array(chunked(txt, size)))
+            self.assertEqual(res, data)
+
+    def test_iter_json_array_empty(self):
+        """An empty array yields nothing"""
+        self.assertEqual(list(other.iter_json_array(["[", " ]"])), [])
+
+    def test_iter_json_array_truncated(self):
+        """A truncated download is an error, not a short list"""
+        with self.assertRaises(ValueError):
+            list(other.iter_json_array(['[{"a": 1}, {"a"']))
+
+    @patch("other.fetch_blocks")
+    def test_merged_blocks(self, fetch):
+        """Sources are merged and de-duplicated by digest"""
+        fetch.side_effect = lambda resp: iter(
+            mock_blocks("a", "b") if resp == "one" else mock_blocks("b", "c")
+        )
+        seen = set()
+        res = [x["domain"] for x in other.merged_blocks(["one", "two"], seen)]
+        self.assertEqual(res, ["a", "b", "c"])
+        self.assertEqual(seen, {"sha-a", "sha-b", "sha-c"})
+
+    def test_clean_blocks(self):
+        """Domains are normalized, except obfuscated ones"""
+        blocks = mock_blocks("Bad.Example.", "b*d.example", "ünï.example")
+        res = list(other.clean_blocks(blocks, size=2))
+        self.assertEqual(
+            [x["domain"] for x in res],
+            ["bad.example", "b*d.example", "xn--n-nga1b.example"],
+        )
+        self.assertEqual(res[0]["digest"], other.host_digest("bad.example"))
+        self.assertEqual(res[1]["digest"], "sha-b*d.example")
+
+    def test_fetch_blocks(self):
+        """fetch_blocks streams just the domain and digest of each block"""
+        body = json.dumps(mock_blocks("a", "b")).encode("utf-8")
+        res = list(other.fetch_blocks(mock_response(200, body)))
+        self.assertEqual(
+            res,
+            [{"domain": "a", "digest": "sha-a"}, {"domain": "b", "digest": "sha-b"}],
+        )
+
+    @patch("other.requests")
+    def test_open_source_conditional(self, requestsmock):
+        """Stored validators are sent as conditional request headers"""
+        other.open_source("url", {"etag": '"abc"', "last_modified": "yesterday"})
+        headers = requestsmock.get.call_args.kwargs["headers"]
+        self.assertEqual(headers["If-None-Match"], '"abc"')
+        self.assertEqual(headers["If-Modified-Since"], "yesterday")
+
+    @patch.object(other, "BLOCKLIST_SOURCES", ["url"])
+    @patch("other.Datastore")
+    @patch("other.open_source")
+    def test_block_update_unchanged(self, open_source, data_store):
+        """A 304 from every known source skips the sync, but not the allow
+        list check"""
+        row = MagicMock()
+        row.sources.as_dict.return_value = {"url": {"etag": '"abc"'}}
+        data_store.get_block_filter_row.return_value = row
+        open_source.return_value = mock_response(304)
+
+        other.block_update({}, {})
+
+        open_source.assert_called_once_with("url", {"etag": '"abc"'})
+        data_store.batch_block_host.assert_not_called()
+        data_store.refresh_block_filter.assert_called_once_with(allowed_only=True)
+
+    @patch.object(other, "BLOCKLIST_SOURCES", ["url"])
+    @patch("other.Datastore")
+    @patch("other.open_source")
+    def test_block_update_changed(self, open_source, data_store):
+        """Changed sources are synced and their validators stored"""
+        data_store.get_block_filter_row.return_value = None
+        body = json.dumps(mock_blocks("a")).encode("utf-8")
+        open_source.return_value = mock_response(200, body, {"ETag": '"new"'})
+        data_store.batch_block_host.side_effect = lambda hosts, ts: (
+            len(list(hosts)),
+            0,
+        )
+
+        other.block_update({}, {})
+
+        digests, _ts, sources = data_store.refresh_block_filter.call_args.args
+        self.assertEqual(digests, {"sha-a"})
+        self.assertEqual(sources["url"]["etag"], '"new"')
@@ -0,0 +1,90 @@
+"""Tests for the local message queues"""
+
+import tempfile
+from unittest import TestCase
+import queues
+
+
+class QueueTests(TestCase):
+    """Tests run against each local queue.  Removed from the module below, so
+    that it only runs through its subclasses."""
+
+    def make_queue(self, visibility_timeout=queues.VISIBILITY_TIMEOUT):
+        """Returns an empty queue"""
+        raise NotImplementedError
+
+    def expire(self, queue):
+        """Lets the visibility timeout of received messages pass"""
+        raise NotImplementedError
+
+    def test_send_receive_delete(self):
+        """Messages come back in order, at most MaxNumberOfMessages at a time"""
+        queue = self.make_queue()
+        queue.send_message(MessageBody="a")
+        res = queue.send_message_batch(
+            Entries=[{"Id": "1", "MessageBody": "b"}, {"Id": "2", "MessageBody": "c"}]
+        )
+        self.assertEqual([x["Id"] for x in res["Successful"]], ["1", "2"])
+
+        msgs = queue.receive_message(MaxNumberOfMessages=2)["Messages"]
+        self.assertEqual([m["Body"] for m in msgs], ["a", "b"])
+        msgs += queue.receive_message(MaxNumberOfMessages=10)["Messages"]
+        self.assertEqual(msgs[2]["Body"], "c")
+        self.assertEqual(queue.receive_message(MaxNumberOfMessages=10), {})
+
+        queue.delete_message_batch(
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]}
+                for (i, m) in enumerate(msgs)
+            ]
+        )
+        self.expire(queue)
+        self.assertEqual(queue.receive_message(MaxNumberOfMessages=10), {})
+
+    def test_redelivery(self):
+        """Messages that aren't deleted are delivered again after a timeout"""
+        queue = self.make_queue()
+        queue.send_message(MessageBody="a")
+        first = queue.receive_message()["Messages"][0]
+        self.assertEqual(queue.receive_message(), {})
+        self.expire(queue)
+        again = queue.receive_message()["Messages"][0]
+        self.assertEqual((again["Body"], again["MessageId"]), ("a", first["MessageId"]))
+
+
+class TestMemoryQueue(QueueTests):
+    """Tests for MemoryQueue"""
+
+    def setUp(self):
+        self.now = 0.0
+
+    def make_queue(self, visibility_timeout=queues.VISIBILITY_TIMEOUT):
+        return queues.MemoryQueue(visibility_timeout, timer=lambda: self.now)
+
+    def expire(self, queue):
+        self.now += queue.visibility_timeout
+
+
+class TestFileQueue(QueueTests):
+    """Tests for FileQueue"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def make_queue(self, visibility_timeout=queues.VISIBILITY_TIMEOUT):
+        return queues.FileQueue(self.directory, visibility_timeout)
+
+    def expire(self, queue):
+        queue.visibility_timeout = -1
+
+    def test_open_queue(self):
+        """Queue URLs pick the backing"""
+        self.assertIsNone(queues.open_queue(""))
+        queue = queues.open_queue(f"file://{self.directory}")
+        self.assertIsInstance(queue, queues.FileQueue)
+        self.assertIs(queues.open_queue("memory://x"), queues.open_queue("memory://x"))
+
+
+del QueueTests
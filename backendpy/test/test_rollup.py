@@ -0,0 +1,100 @@
+"""Tests for telemetry rollups"""
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+import columnar
+import rollup
+
+HOUR = 3600
+T0 = 1700000000 // HOUR * HOUR
+
+# A batch record as logged by telemetry.log_events, an old-style single event
+# with a Lambda log prefix, and some noise.
+LINES = [
+    "[INFO]\t2023-11-14T22:30:00.000Z\treq1\t"
+    + json.dumps(
+        {
+            "ts": T0 + 10,
+            "telemetry": [
+                {"action": "info", "acct": "a@x.social", "elapsed_ms": 100},
+                {"action": "info", "acct": "b@x.social", "elapsed_ms": 300},
+                {"action": "export", "acct": "c@y.social"},
+                "junk",
+            ],
+        }
+    ),
+    "[INFO]\t2023-11-14T23:10:00.000Z\treq2\t"
+    + json.dumps({"action": "info", "acct": "a@X.social", "elapsed_ms": 50}),
+    "START RequestId: req3 Version: $LATEST",
+    "{not json",
+]
+
+
+class TestRollup(TestCase):
+    """Tests for building and querying rollups"""
+
+    def test_read_events(self):
+        """Batch records, single events and log timestamps are understood"""
+        events = list(rollup.read_events(LINES))
+        self.assertEqual(len(events), 4)
+        self.assertEqual(events[0][0], T0 + 10)
+        self.assertEqual(events[3][0], T0 + HOUR + 600)
+
+    def test_build(self):
+        """Events are grouped by bucket, type and domain"""
+        res = rollup.Rollup.build(rollup.read_events(LINES))
+        rows = list(res.rows())
+        self.assertEqual(
+            [(r["bucket"], r["type"], r["domain"], r["count"]) for r in rows],
+            [
+                (T0, "info", "x.social", 2),
+                (T0, "export", "y.social", 1),
+                (T0 + HOUR, "info", "x.social", 1),
+            ],
+        )
+        self.assertEqual((rows[0]["min_ms"], rows[0]["max_ms"]), (100, 300))
+        self.assertEqual(rows[1]["timed"], 0)
+
+    def test_save_and_query(self):
+        """A saved rollup can be loaded and queried"""
+        events = [
+            (T0 + i * 60, {"action": f"a{i % 3}", "domain": f"d{i % 5}"})
+            for i in range(1000)
+        ]
+        built = rollup.Rollup.build(events)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "t.tlr")
+            built.save(path)
+            loaded = rollup.Rollup.load(path)
+            self.assertEqual(len(loaded), len(built))
+            totals = loaded.totals(by="type")
+            self.assertEqual(sum(x["count"] for x in totals.values()), 1000)
+            self.assertEqual(totals["a0"]["count"], 334)
+            self.assertIsNone(totals["a0"]["mean_ms"])
+
+            window = loaded.totals(by="domain", start=T0 + HOUR, end=T0 + 3 * HOUR)
+            self.assertEqual(sum(x["count"] for x in window.values()), 120)
+            self.assertEqual(
+                loaded.totals(by="bucket", type_="a1", domain="d2"),
+                built.totals(by="bucket", type_="a1", domain="d2"),
+            )
+            self.assertEqual(loaded.totals(type_="nope"), {})
+
+    def test_not_a_rollup(self):
+        """Other files are rejected"""
+        with self.assertRaises(ValueError):
+            rollup.Rollup.frombuffer(b"\0" * columnar.HEADER.size)
+
+    def test_incomplete_column_file(self):
+        """Column files missing a part of the format can't be made"""
+
+        class Partial(columnar.ColumnFile):  # pylint: disable=abstract-method
+            """Can save, but not load"""
+
+            def parts(self):
+                return ([], {})
+
+        with self.assertRaises(TypeError):
+            Partial()  # pylint: disable=abstract-class-instantiated
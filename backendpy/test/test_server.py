@@ -3,9 +3,11 @@
 import json
 import logging
 import os
+import time
 from unittest.mock import MagicMock, patch, sentinel
 from unittest import TestCase
 from mastodon import MastodonAPIError
+from pynamodb.exceptions import DeleteError, PutError
 import server
 import shared
 
@@ -82,10 +84,11 @@ class TestAuth(TestCase):
         self.assertEqual(res["statusCode"], 500)
         self.assertEqual(json.loads(res["body"])["status"], "bad_host")
 
+    @patch("shared.AppLease")
     @patch("shared.Datastore")
     @patch("shared.MastodonFactory", new_callable=mock_factory)
     @patch("shared.make_app")
-    def test_auth_nocookie_newhost(self, make_app, _factory, dataStore):
+    def test_auth_nocookie_newhost(self, make_app, _factory, dataStore, _lease):
         """Test /auth when we haven't seen this host before"""
 
         (event, context) = setupNoCookies()
@@ -103,6 +106,128 @@ class TestAuth(TestCase):
         # We should have created a new mastodon app
         self.assertTrue(make_app.called)
 
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_waits(self, make_app, dataStore, lease):
+        """Test register_app when another invocation is registering the app"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.return_value = False
+        lease.wait.return_value = sentinel.host_cfg
+
+        res = shared.register_app("mydomain", "https://redirect")
+        # We should use the other invocation's app rather than making one
+        self.assertIs(res, sentinel.host_cfg)
+        self.assertFalse(make_app.called)
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_busy(self, make_app, dataStore, lease):
+        """Test register_app when another invocation is still registering
+        the app after we stop waiting"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.return_value = False
+        lease.wait.return_value = None
+
+        with self.assertRaises(shared.AppBusy):
+            shared.register_app("mydomain", "https://redirect")
+        # We shouldn't make a second app while they might still be
+        self.assertFalse(make_app.called)
+        self.assertEqual(lease.acquire.call_count, 2)
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_lapsed(self, make_app, dataStore, lease):
+        """Test register_app when another invocation gave up its lease"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.side_effect = [False, True]
+        lease.wait.return_value = None
+        make_app.return_value = ("id", "secret")
+
+        res = shared.register_app("mydomain", "https://redirect")
+        self.assertIs(res, dataStore.set_host_config.return_value)
+        self.assertTrue(make_app.called)
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_retry_fails(self, make_app, dataStore, lease):
+        """Test register_app when retaking a lapsed lease fails"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.side_effect = [False, PutError()]
+        lease.wait.return_value = None
+
+        with self.assertRaises(shared.AppBusy):
+            shared.register_app("mydomain", "https://redirect")
+        self.assertFalse(make_app.called)
+
+    @patch("shared.Datastore")
+    @patch("shared.MastodonFactory", new_callable=mock_factory)
+    @patch("shared.register_app", side_effect=shared.AppBusy)
+    def test_auth_busy(self, _register_app, _factory, dataStore):
+        """Test /auth when the app for a host is still being registered"""
+
+        (event, context) = setupNoCookies()
+        event["queryStringParameters"] = {"domain": "mydomain"}
+        dataStore.is_allowed.return_value = True
+        dataStore.get_host_config.return_value = None
+
+        res = shared.auth(event, context)
+        self.assertEqual(res["statusCode"], 503)
+        self.assertEqual(json.loads(res["body"])["status"], "busy")
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_no_lease(self, make_app, dataStore, lease):
+        """Test register_app when the lease can't be taken at all"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.side_effect = PutError()
+        make_app.side_effect = RuntimeError("nope")
+
+        with self.assertRaises(RuntimeError):
+            shared.register_app("mydomain", "https://redirect")
+        # There's no lease to give up
+        self.assertFalse(lease.release.called)
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_release_fails(self, make_app, dataStore, lease):
+        """Test register_app when giving up the lease fails too"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.return_value = True
+        lease.release.side_effect = DeleteError()
+        make_app.side_effect = RuntimeError("nope")
+
+        # We should see the original error
+        with self.assertRaises(RuntimeError):
+            shared.register_app("mydomain", "https://redirect")
+
+    @patch("shared.AppLease")
+    @patch("shared.Datastore")
+    @patch("shared.make_app")
+    def test_register_app_fails(self, make_app, dataStore, lease):
+        """Test register_app when making the app fails"""
+
+        dataStore.get_host_config.return_value = None
+        lease.acquire.return_value = True
+        make_app.side_effect = RuntimeError("nope")
+
+        with self.assertRaises(RuntimeError):
+            shared.register_app("mydomain", "https://redirect")
+        # We should give up the lease, so that others can try
+        self.assertTrue(lease.release.called)
+        self.assertFalse(dataStore.set_host_config.called)
+
     @patch("shared.Datastore")
     @patch("shared.MastodonFactory", new_callable=mock_factory)
     @patch("shared.make_app")
@@ -135,6 +260,7 @@ class TestAuth(TestCase):
         data_store.is_allowed.return_value = True
         auth = MagicMock()
         auth.domain = "mydomain"
+        auth.verified_at = None
         data_store.get_auth.return_value = auth
 
         res = shared.auth(event, context)
@@ -146,6 +272,66 @@ class TestAuth(TestCase):
         # We should not have created a new app
         self.assertFalse(make_app.called)
 
+    @patch("shared.AuthSession")
+    @patch("shared.Datastore")
+    @patch("shared.MastodonFactory", new_callable=mock_factory)
+    def test_auth_cookie_recently_verified(self, factory, data_store, session):
+        """Test /auth when the session was checked against its server recently"""
+
+        (event, context) = setupWithCookies()
+
+        auth = MagicMock()
+        auth.domain = "mydomain"
+        auth.verified_at = time.time() - 10
+        data_store.get_auth.return_value = auth
+
+        res = shared.auth(event, context)
+        self.assertEqual(res["statusCode"], 200)
+        self.assertEqual(json.loads(res["body"])["status"], "OK")
+        # We shouldn't have asked the server again
+        factory.from_cookie.assert_not_called()
+        # But the session is still in use, so may need renewing
+        session.renew.assert_called_with(auth)
+
+    @patch("shared.AuthSession")
+    @patch("shared.Datastore")
+    @patch("shared.MastodonFactory", new_callable=mock_factory)
+    def test_auth_cookie_stale(self, factory, data_store, session):
+        """Test /auth when the session was last checked a while ago"""
+
+        (event, context) = setupWithCookies()
+
+        auth = MagicMock()
+        auth.domain = "mydomain"
+        auth.verified_at = time.time() - shared.VERIFY_FRESH - 10
+        data_store.get_auth.return_value = auth
+
+        res = shared.auth(event, context)
+        self.assertEqual(json.loads(res["body"])["status"], "OK")
+        # We should have checked with the server, and recorded that we did
+        factory.from_cookie.return_value.me.assert_called_with()
+        session.set_verified.assert_called_once()
+
+    @patch("shared.AuthSession")
+    @patch("shared.Datastore")
+    @patch("shared.MastodonFactory", new_callable=mock_factory)
+    def test_auth_cookie_revoked(self, factory, data_store, session):
+        """Test /auth when a previously verified session has been revoked"""
+
+        (event, context) = setupWithCookies()
+        factory.from_cookie.return_value.me.side_effect = MastodonAPIError
+
+        data_store.is_allowed.return_value = True
+        auth = MagicMock()
+        auth.domain = "mydomain"
+        auth.verified_at = time.time() - shared.VERIFY_FRESH - 10
+        data_store.get_auth.return_value = auth
+
+        res = shared.auth(event, context)
+        self.assertEqual(json.loads(res["body"])["url"], "https://mock_redirect")
+        # The session should be checked again next time
+        session.set_verified.assert_called_with(auth, None)
+
     @patch("shared.Datastore")
     @patch("shared.MastodonFactory", new_callable=mock_factory)
     @patch("shared.make_app")
@@ -158,6 +344,7 @@ class TestAuth(TestCase):
         factory.from_cookie.return_value.me.side_effect = shared.NoAuthInfo
 
         data_store.is_allowed.return_value = True
+        data_store.get_auth.return_value.verified_at = None
 
         res = shared.auth(event, context)
         # We should return a 200 response with the correct redirect URL.
@@ -183,6 +370,7 @@ class TestAuth(TestCase):
         data_store.is_allowed.return_value = True
         auth = MagicMock()
         auth.domain = "mydomain"
+        auth.verified_at = None
         data_store.get_auth.return_value = auth
 
         res = shared.auth(event, context)
@@ -207,6 +395,7 @@ class TestAuth(TestCase):
         data_store.is_allowed.return_value = True
         auth = MagicMock()
         auth.domain = "mydomain"
+        auth.verified_at = None
         data_store.get_auth.return_value = auth
 
         res = shared.auth(event, context)
@@ -219,11 +408,12 @@ class TestAuth(TestCase):
         self.assertFalse(make_app.called)
 
     # Test auth with URL instead of a domain
+    @patch("shared.AppLease")
     @patch("shared.Datastore")
     @patch("shared.MastodonFactory", new_callable=mock_factory)
     @patch("shared.make_app")
     @patch.dict(os.environ, {"AUTH_REDIRECT": "https://test_redirect"})
-    def test_auth_nocookie_urlhost(self, make_app, _factory, dataStore):
+    def test_auth_nocookie_urlhost(self, make_app, _factory, dataStore, _lease):
         """Test /auth when we haven't seen this host before"""
 
         (event, context) = setupNoCookies()
@@ -257,6 +447,8 @@ class TestAuth(TestCase):
         factory.from_cookie.assert_called_with("mycookie")
         # We should drop the access token
         self.assertTrue(mastomock.revoke_access_token.called)
+        # And forget the pooled client for it
+        factory.evict.assert_called_with(mastomock)
         # We should drop the auth from dynamodb
         data_store.drop_auth.assert_called_with("mycookie")
 
@@ -264,7 +456,7 @@ class TestAuth(TestCase):
 class TestMakeApp(TestCase):
     """Tests for make_app"""
 
-    @patch("shared.Mastodon.create_app", return_value=("id", "secret"))
+    @patch("shared.mastodonpy.Mastodon.create_app", return_value=("id", "secret"))
     def test_makeapp_agent(self, create_app):
         """make_app must be called with a session object that includes a user-agent header"""
         shared.make_app("domain", "https://redirect_url")
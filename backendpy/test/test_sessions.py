@@ -0,0 +1,113 @@
+"""Tests for stateless session cookies"""
+
+import base64
+import time
+from unittest import TestCase
+from unittest.mock import patch
+import sessions
+from models import AuthSession, Datastore
+
+KEY1 = base64.urlsafe_b64encode(b"k" * 32).decode()
+KEY2 = base64.urlsafe_b64encode(b"j" * 32).decode()
+
+
+class TestSessions(TestCase):
+    """Tests for sealing and opening cookies"""
+
+    def setUp(self):
+        patcher = patch("sessions.keys", sessions.parse_keys(f"a:{KEY1}"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Datastore.clear_caches()
+
+    def test_roundtrip(self):
+        """A sealed cookie opens to the session it was sealed with"""
+        cookie = sessions.seal("mydomain", "secret-token", time.time() + 60)
+        self.assertTrue(sessions.is_sealed(cookie))
+        self.assertNotIn("secret-token", cookie)
+        session = sessions.open_cookie(cookie)
+        self.assertEqual(session.domain, "mydomain")
+        self.assertEqual(session.token, "secret-token")
+        self.assertEqual(session.key, cookie)
+
+    def test_tampered(self):
+        """Changing any byte of a cookie makes it unopenable"""
+        cookie = sessions.seal("mydomain", "token", time.time() + 60)
+        body = cookie.split(".")[2]
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        for i, byte in enumerate(raw):
+            forged = raw[:i] + bytes([byte ^ 1]) + raw[i + 1 :]
+            forged = "s1.a." + base64.urlsafe_b64encode(forged).decode()
+            self.assertIsNone(sessions.open_cookie(forged))
+        self.assertIsNone(sessions.open_cookie("s1.a"))
+        self.assertIsNone(sessions.open_cookie("s1.a.!!!"))
+        self.assertIsNone(sessions.open_cookie("s2.a." + body))
+
+    def test_rotation(self):
+        """Cookies sealed with an older key open until it is dropped"""
+        cookie = sessions.seal("mydomain", "token", time.time() + 60)
+        with patch("sessions.keys", sessions.parse_keys(f"b:{KEY2},a:{KEY1}")):
+            self.assertIsNotNone(sessions.open_cookie(cookie))
+            self.assertTrue(sessions.seal("d", "t", time.time()).startswith("s1.b."))
+        with patch("sessions.keys", sessions.parse_keys(f"b:{KEY2}")):
+            self.assertIsNone(sessions.open_cookie(cookie))
+        # A different key under the same id doesn't open it either
+        with patch("sessions.keys", sessions.parse_keys(f"a:{KEY2}")):
+            self.assertIsNone(sessions.open_cookie(cookie))
+
+    def test_expired(self):
+        """Expired cookies don't open"""
+        cookie = sessions.seal("mydomain", "token", time.time() - 1)
+        self.assertIsNone(sessions.open_cookie(cookie))
+
+    @patch("models.RevokedSession")
+    def test_revoke(self, revokedmock):
+        """Logged out cookies are recorded in the revoked table"""
+        revokedmock.lookup.return_value = None
+        cookie = sessions.seal("mydomain", "token", time.time() + 60)
+        other = sessions.seal("mydomain", "token", time.time() + 60)
+        session = Datastore.get_auth(cookie)
+        Datastore.drop_auth(cookie)
+        revokedmock.assert_called_with(session.jti, expires_at=session.expires_at)
+        revokedmock.return_value.save.assert_called_once_with()
+        self.assertIsNone(Datastore.get_auth(cookie))
+        self.assertIsNotNone(Datastore.get_auth(other))
+
+    @patch("models.RevokedSession")
+    def test_revoked_elsewhere(self, revokedmock):
+        """Cookies logged out by another process don't open"""
+        cookie = sessions.seal("mydomain", "token", time.time() + 60)
+        revokedmock.lookup.return_value = "row"
+        self.assertIsNone(Datastore.get_auth(cookie))
+        (jti,) = revokedmock.lookup.call_args.args
+        self.assertEqual(jti, sessions.open_cookie(cookie).jti)
+
+    def test_bad_keys(self):
+        """Malformed key settings are rejected"""
+        with self.assertRaises(ValueError):
+            sessions.parse_keys("a:c2hvcnQ")
+        with self.assertRaises(ValueError):
+            sessions.parse_keys(f"a.b:{KEY1}")
+        self.assertEqual(sessions.parse_keys(""), [])
+
+    @patch("models.RevokedSession")
+    @patch("models.AuthTable")
+    def test_datastore(self, authmock, revokedmock):
+        """With keys set, sessions never touch the auth table"""
+        revokedmock.lookup.return_value = None
+        cookie = Datastore.new_session(token="token", domain="mydomain")
+        self.assertTrue(sessions.is_sealed(cookie))
+        self.assertEqual(Datastore.get_auth(cookie).token, "token")
+        self.assertFalse(AuthSession.renew(Datastore.get_auth(cookie)))
+        Datastore.drop_auth(cookie)
+        self.assertIsNone(Datastore.get_auth(cookie))
+        authmock.lookup.assert_not_called()
+        authmock.return_value.save.assert_not_called()
+
+    @patch("models.AuthTable")
+    def test_datastore_disabled(self, authmock):
+        """Without keys, sessions are kept in the auth table"""
+        with patch("sessions.keys", []):
+            cookie = Datastore.new_session(token="token", domain="mydomain")
+        self.assertFalse(sessions.is_sealed(cookie))
+        authmock.return_value.save.assert_called_once()
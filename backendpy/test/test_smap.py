@@ -0,0 +1,204 @@
+"""Tests for JS source mapping"""
+
+import json
+import os
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
+from unittest import TestCase
+import smap
+
+BUNDLE_URL = "https://example.com/static/js/main.js"
+
+BUNDLE = "render();main();\nrender();\n//# sourceMappingURL=main.js.map\n"
+
+SOURCEMAP = json.dumps(
+    {
+        "version": 3,
+        "sources": ["src/App.tsx"],
+        "names": ["render", "main"],
+        "mappings": "AAAAA,KAEEC;AAEFD",
+    }
+)
+
+STACK = f"""TypeError: oops
+    at main ({BUNDLE_URL}:1:7)
+    at render ({BUNDLE_URL}:2:3)"""
+
+
+def mock_get(url, timeout=None):
+    """A stand-in for requests.get serving the bundle and its map"""
+    if timeout is None:
+        raise ValueError(f"Fetch of {url} has no timeout")
+    res = MagicMock()
+    res.text = SOURCEMAP if url.endswith(".map") else BUNDLE
+    return res
+
+
+class TestSmap(TestCase):
+    """Tests for stack trace mapping"""
+
+    def setUp(self):
+        smap.index_cache.clear()
+        local = patch("smap.LOCAL_DIR", "")
+        local.start()
+        self.addCleanup(local.stop)
+
+    @patch("smap.session.get", side_effect=mock_get)
+    def test_map_stacktrace(self, get):
+        """Frames are mapped, and each map is fetched and parsed once"""
+        with patch.object(
+            smap.CompactIndex, "from_json", wraps=smap.CompactIndex.from_json
+        ) as loads:
+            res = smap.map_stacktrace(STACK)
+        self.assertEqual(res, ["main (src/App.tsx:2)", "render (src/App.tsx:4)"])
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(loads.call_count, 1)
+        self.assertTrue(smap.have_maps(STACK))
+
+    @patch("smap.session.get")
+    def test_map_stacktrace_deadline(self, get):
+        """Frames whose maps don't arrive before the deadline are returned raw"""
+        release = threading.Event()
+
+        def slow_get(url, timeout=None):
+            release.wait(min(timeout, 5))
+            raise ConnectionError(url)
+
+        get.side_effect = slow_get
+        try:
+            res = smap.map_stacktrace(STACK, deadline=0.05)
+        finally:
+            release.set()
+        self.assertEqual(res, [x.strip() for x in STACK.split("\n")[1:]])
+        self.assertFalse(smap.have_maps(STACK))
+
+    @patch("smap.session.get", side_effect=mock_get)
+    def test_map_stacktrace_bad_frame(self, _get):
+        """Frames outside the map are returned raw"""
+        res = smap.map_stacktrace(f"at x ({BUNDLE_URL}:9:1)")
+        self.assertEqual(res, [f"at x ({BUNDLE_URL}:9:1)"])
+
+    def test_cache_eviction(self):
+        """The cache evicts least recently used maps by size"""
+        cache = smap.IndexCache(100)
+        cache.put("a", "index-a", 60)
+        cache.put("b", "index-b", 30)
+        cache.get("a")
+        cache.put("c", "index-c", 30)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "index-a")
+        self.assertEqual(cache.size, 90)
+
+    def test_cache_persist(self):
+        """Parsed maps saved to disk survive eviction from memory"""
+        index = smap.CompactIndex.from_json(SOURCEMAP)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = smap.IndexCache(100, directory)
+            cache.put("a", index, index.nbytes)
+            cache.clear()
+            loaded = cache.get("a")
+            self.assertEqual(str(loaded.lookup(0, 7)), "main")
+
+
+class TestLocalStore(TestCase):
+    """Tests for maps precomputed at build time"""
+
+    def setUp(self):
+        smap.index_cache.clear()
+        tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmp.cleanup)
+        self.build = os.path.join(tmp.name, "build")
+        self.store = os.path.join(tmp.name, "smaps")
+        os.makedirs(self.build)
+        with open(os.path.join(self.build, "main.js"), "w", encoding="utf-8") as f:
+            f.write(BUNDLE)
+        with open(os.path.join(self.build, "main.js.map"), "w", encoding="utf-8") as f:
+            f.write(SOURCEMAP)
+        with open(os.path.join(self.build, "nomap.js"), "w", encoding="utf-8") as f:
+            f.write("x();\n")
+
+    def test_build_store(self):
+        """Only bundles with a source map are indexed, and old ones go away"""
+        os.makedirs(self.store)
+        stale = os.path.join(self.store, "old.js.smidx")
+        with open(stale, "wb") as f:
+            f.write(b"")
+        self.assertEqual(smap.build_store(self.build, self.store), ["main.js"])
+        self.assertEqual(os.listdir(self.store), ["main.js.smidx"])
+
+    @patch("smap.session.get")
+    def test_map_stacktrace_local(self, get):
+        """Bundles in the local store are mapped without fetching anything"""
+        smap.build_store(self.build, self.store)
+        with patch("smap.LOCAL_DIR", self.store):
+            res = smap.map_stacktrace(STACK.replace("main.js", "main.js?v=1"))
+        self.assertEqual(res, ["main (src/App.tsx:2)", "render (src/App.tsx:4)"])
+        get.assert_not_called()
+
+    @patch("smap.session.get", side_effect=mock_get)
+    def test_map_stacktrace_fallback(self, get):
+        """Bundles missing from the local store are fetched"""
+        with patch("smap.LOCAL_DIR", self.store):
+            res = smap.map_stacktrace(STACK)
+        self.assertEqual(res, ["main (src/App.tsx:2)", "render (src/App.tsx:4)"])
+        self.assertEqual(get.call_count, 2)
+
+    def test_bundle_name(self):
+        """Only plain bundle file names are looked up locally"""
+        self.assertEqual(smap.bundle_name(BUNDLE_URL + "#x"), "main.js")
+        self.assertIsNone(smap.bundle_name("https://example.com/static/js/"))
+        self.assertIsNone(smap.bundle_name("https://example.com/..%2F.js"))
+        self.assertIsNone(smap.bundle_name("https://example.com/x.map"))
+
+
+class TestCompactIndex(TestCase):
+    """Tests for the array-backed source map index"""
+
+    def assert_same_lookups(self, text, positions):
+        """Checks CompactIndex agrees with sourcemap.loads"""
+        expected = smap.sourcemap.loads(text)
+        index = smap.CompactIndex.from_json(text)
+        for line, column in positions:
+            try:
+                want = expected.lookup(line, column)
+            except IndexError:
+                with self.assertRaises(IndexError):
+                    index.lookup(line, column)
+                continue
+            self.assertEqual(index.lookup(line, column), want)
+
+    def test_matches_sourcemap(self):
+        """Lookups match the sourcemap library"""
+        positions = [(line, col) for line in range(3) for col in range(10)]
+        self.assert_same_lookups(SOURCEMAP, positions)
+
+    def test_unsorted_and_source_root(self):
+        """Out-of-order columns, sourceless segments and sourceRoot"""
+        text = json.dumps(
+            {
+                "version": 3,
+                "sourceRoot": "webpack://",
+                "sources": ["a.js", "b.js"],
+                "names": ["x"],
+                "mappings": "KACA,LADAA,C;E",
+            }
+        )
+        index = smap.CompactIndex.from_json(text)
+        token = index.lookup(0, 0)
+        self.assertEqual(
+            (token.name, token.src, token.src_line), ("x", "webpack://a.js", 0)
+        )
+        self.assertIsNone(index.lookup(0, 3).src)
+        token = index.lookup(0, 7)
+        self.assertEqual((token.dst_col, token.src_line), (5, 1))
+        with self.assertRaises(IndexError):
+            index.lookup(1, 1)
+
+    def test_roundtrip(self):
+        """An index survives dumping and reloading from a buffer"""
+        index = smap.CompactIndex.from_json(SOURCEMAP)
+        loaded = smap.CompactIndex.frombuffer(index.dumps())
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.lookup(1, 3), index.lookup(1, 3))
+        self.assertEqual(loaded.lookup(0, 100), index.lookup(0, 100))
@@ -0,0 +1,251 @@
+"""Tests for the telemetry and error handlers"""
+
+import base64
+import gzip
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+from unittest import TestCase
+import queues
+import telemetry
+
+STACK = "TypeError: oops\n    at f (https://example.com/static/js/main.js:1:7)"
+OTHER = "TypeError: oops\n    at g (https://example.com/static/js/main.js:2:3)"
+
+
+def fake_map(stacks):
+    """Stands in for smap.map_stacktraces"""
+    return [[f"mapped {s.split(' at ')[1][0]}"] for s in stacks]
+
+
+@patch("smap.map_stacktraces", side_effect=fake_map)
+class TestError(TestCase):
+    """Tests for error reporting"""
+
+    def setUp(self):
+        telemetry.mapped_stacks.clear()
+        self.now = 1000.0
+        aggregator = telemetry.ErrorAggregator(interval=60, timer=lambda: self.now)
+        patcher = patch("telemetry.aggregator", aggregator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def report(self, stack, **kwargs):
+        """Returns an error event"""
+        return {"body": json.dumps({"message": "oops", "stack": stack, **kwargs})}
+
+    @patch("telemetry.error_queue", None)
+    @patch("telemetry.logging")
+    def test_error_sync(self, logs, mapper):
+        """Without a queue, reports are mapped and logged right away"""
+        res = telemetry.error(self.report(STACK), None)
+        self.assertEqual(res["statusCode"], 200)
+        self.assertEqual(mapper.call_count, 1)
+        logged = json.loads(logs.error.call_args[0][0])
+        self.assertEqual(logged["stack"], "mapped f")
+
+    @patch("telemetry.error_queue", None)
+    def test_error_bad_report(self, mapper):
+        """Reports that aren't JSON objects are rejected"""
+        for body in ("nope", "[1]", json.dumps({"stack": 3})):
+            res = telemetry.error({"body": body}, None)
+            self.assertEqual(res["statusCode"], 400)
+        mapper.assert_not_called()
+
+    @patch("telemetry.logging")
+    def test_error_queued(self, logs, mapper):
+        """With a queue, the handler only enqueues, and the worker maps each
+        distinct stack once per batch"""
+        queue = queues.MemoryQueue()
+        with patch("telemetry.error_queue", queue):
+            for stack in (STACK, OTHER, STACK, "  " + STACK):
+                telemetry.error(self.report(stack), None)
+            queue.send_message(MessageBody="garbage")
+            mapper.assert_not_called()
+            self.assertEqual(len(queue), 5)
+
+            telemetry.error_worker({}, None)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(mapper.call_count, 1)
+        self.assertEqual(len(mapper.call_args[0][0]), 2)
+        logged = [json.loads(c[0][0]) for c in logs.error.call_args_list]
+        self.assertEqual([x["stack"] for x in logged[:2]], ["mapped f", "mapped g"])
+        # And the two repeats of the first are counted
+        self.assertEqual(logged[2]["count"], 2)
+
+    @patch("telemetry.logging")
+    def test_error_worker_sqs(self, logs, mapper):
+        """Batches delivered by an SQS trigger are mapped together"""
+        event = {"Records": [{"body": self.report(s)["body"]} for s in (STACK, STACK)]}
+        telemetry.error_worker(event, None)
+        self.assertEqual(mapper.call_count, 1)
+        # The first report, then the count of repeats
+        self.assertEqual(logs.error.call_count, 2)
+
+    @patch("telemetry.logging")
+    def test_error_worker_flushes(self, logs, _mapper):
+        """Repeat counts are logged at the end of a batch, even if no further
+        report ever arrives"""
+        records = [{"body": self.report(STACK)["body"]} for _ in range(3)]
+        telemetry.error_worker({"Records": records}, None)
+        flushed = json.loads(logs.error.call_args[0][0])
+        self.assertEqual(flushed["count"], 2)
+
+        # Nothing is left to be logged later
+        logs.reset_mock()
+        self.now += 61
+        telemetry.aggregator.flush(force=True)
+        logs.error.assert_not_called()
+
+    @patch("telemetry.error_queue", None)
+    @patch("telemetry.logging")
+    def test_aggregation(self, logs, mapper):
+        """Repeats are counted, not logged, until a flush is due, and stacks
+        already seen aren't mapped again"""
+        for i in range(5):
+            telemetry.error(self.report(STACK, message=f"oops {i}"), None)
+        telemetry.error(self.report(OTHER), None)
+        self.assertEqual(mapper.call_count, 2)
+        self.assertEqual(logs.error.call_count, 2)
+        first = json.loads(logs.error.call_args_list[0][0][0])
+        self.assertEqual(first["message"], "oops 0")
+
+        self.now += 61
+        telemetry.error(self.report(STACK, message="oops 9"), None)
+        self.assertEqual(mapper.call_count, 2)
+        self.assertEqual(logs.error.call_count, 3)
+        flushed = json.loads(logs.error.call_args[0][0])
+        self.assertEqual(flushed["fingerprint"], first["fingerprint"])
+        self.assertEqual(flushed["count"], 5)
+        self.assertEqual(flushed["sample"]["message"], "oops 9")
+
+    @patch("telemetry.RETRY_TTL", 0)
+    @patch("telemetry.error_queue", None)
+    @patch("smap.have_maps")
+    def test_unmapped_retried(self, have_maps, mapper):
+        """Stacks whose maps didn't load are mapped again next time"""
+        have_maps.return_value = False
+        telemetry.error(self.report(STACK), None)
+        telemetry.error(self.report(STACK), None)
+        self.assertEqual(mapper.call_count, 2)
+
+        have_maps.return_value = True
+        telemetry.error(self.report(STACK), None)
+        telemetry.error(self.report(STACK), None)
+        self.assertEqual(mapper.call_count, 3)
+
+    def test_fingerprint(self, _mapper):
+        """Fingerprints ignore numbers in messages and frame positions"""
+        fp = telemetry.error_fingerprint
+        frames = ["f (https://x/main.js?v=1:1:7)", "g (src/App.tsx:4)"]
+        moved = ["f (https://x/main.js?v=2:1:9)", "g (src/App.tsx:5)"]
+        self.assertEqual(
+            fp({"message": "bad 1"}, frames), fp({"message": "bad 22"}, moved)
+        )
+        self.assertNotEqual(
+            fp({"message": "bad"}, frames), fp({"message": "x"}, frames)
+        )
+        self.assertNotEqual(fp({}, frames), fp({}, frames[1:]))
+
+
+class TestTelemetry(TestCase):
+    """Tests for telemetry ingestion"""
+
+    def logged(self, logs):
+        """Returns the events logged by each info call"""
+        return [
+            json.loads(c[0][0] % c[0][1:])["telemetry"]
+            for c in logs.info.call_args_list
+        ]
+
+    @patch("telemetry.logging")
+    def test_single(self, logs):
+        """A lone event is still accepted"""
+        res = telemetry.telemetry({"body": json.dumps({"action": "x"})}, None)
+        self.assertEqual(json.loads(res["body"])["accepted"], 1)
+        # Even if it is pretty-printed over several lines
+        body = json.dumps({"action": "y"}, indent=2)
+        res = telemetry.telemetry({"body": body}, None)
+        self.assertEqual(json.loads(res["body"])["accepted"], 1)
+        self.assertEqual(self.logged(logs), [[{"action": "x"}], [{"action": "y"}]])
+
+    @patch("telemetry.logging")
+    def test_batch_formats(self, logs):
+        """Arrays and NDJSON, plain or gzipped, are logged as one record"""
+        events = [{"action": "a"}, {"action": "b", "n": 2}]
+        array = json.dumps(events).encode()
+        ndjson = "\n".join(json.dumps(x) for x in events).encode() + b"\n"
+        bodies = [
+            {"body": array.decode()},
+            {"body": ndjson.decode()},
+            {
+                "body": base64.b64encode(gzip.compress(array)).decode(),
+                "isBase64Encoded": True,
+                "headers": {"Content-Encoding": "gzip"},
+            },
+            {
+                "body": base64.b64encode(gzip.compress(ndjson)).decode(),
+                "isBase64Encoded": True,
+            },
+        ]
+        for event in bodies:
+            res = telemetry.telemetry(event, None)
+            self.assertEqual(res["statusCode"], 200)
+        self.assertEqual(self.logged(logs), [events] * 4)
+
+    @patch("telemetry.logging")
+    def test_validation(self, logs):
+        """Non-object events are dropped, and bad bodies are rejected"""
+        res = telemetry.telemetry({"body": json.dumps([{"a": 1}, 2, "x"])}, None)
+        self.assertEqual(json.loads(res["body"])["rejected"], 2)
+        self.assertEqual(self.logged(logs), [[{"a": 1}]])
+        logs.warning.assert_called_once()
+
+        for body in ("[1, 2]", "{nope", "[" + "{}," * telemetry.MAX_EVENTS + "{}]"):
+            res = telemetry.telemetry({"body": body}, None)
+            self.assertEqual(res["statusCode"], 400)
+        bomb = gzip.compress(b" " * (telemetry.MAX_BODY + 10))
+        res = telemetry.telemetry(
+            {"body": base64.b64encode(bomb).decode(), "isBase64Encoded": True}, None
+        )
+        self.assertEqual(res["statusCode"], 400)
+
+    @patch("telemetry.MAX_RECORD", 40)
+    @patch("telemetry.logging")
+    def test_record_size(self, logs):
+        """Large batches are split across records"""
+        events = [{"action": f"event{i}"} for i in range(5)]
+        telemetry.telemetry({"body": json.dumps(events)}, None)
+        logged = self.logged(logs)
+        self.assertGreater(len(logged), 1)
+        self.assertEqual(sum(logged, []), events)
+
+
+class TestColdStart(TestCase):
+    """Tests that handlers defer their heavy imports"""
+
+    def loaded(self, module):
+        """Returns the modules executed by importing module in a new
+        interpreter"""
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        lines = [x.split("|")[-1].strip() for x in res.stderr.splitlines()]
+        return {x.split(".")[0] for x in lines}
+
+    def test_telemetry_imports(self):
+        """The telemetry handlers don't load the Mastodon, DynamoDB or source
+        map stacks"""
+        loaded = self.loaded("telemetry")
+        for lib in ("mastodon", "pynamodb", "requests", "sourcemap", "smap"):
+            self.assertNotIn(lib, loaded)
+
+    def test_shared_imports(self):
+        """The auth handlers only load Mastodon.py when they need it"""
+        self.assertNotIn("mastodon", self.loaded("shared"))
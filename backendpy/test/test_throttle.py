@@ -0,0 +1,154 @@
+"""Tests for DynamoDB rate limiting"""
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import PutError
+from throttle import BatchWriter, TokenBucket
+
+
+class FakeClock:
+    """A clock that only moves when something sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def timer(self):
+        """Returns the current time"""
+        return self.now
+
+    def sleep(self, secs):
+        """Advances the clock"""
+        self.slept.append(secs)
+        self.now += secs
+
+
+def mock_model():
+    """Returns a mock model"""
+    model = MagicMock()
+    model.__name__ = "MockModel"
+    model.Meta.table_name = "table"
+    return model
+
+
+def mock_connection(*responses):
+    """Returns a mock table connection that returns each response in turn"""
+    conn = MagicMock()
+    conn.batch_write_item.side_effect = list(responses)
+    return conn
+
+
+def mock_item(key):
+    """Returns a mock pynamodb item"""
+    item = MagicMock()
+    item.serialize.return_value = {"key": {"S": key}}
+    return item
+
+
+def consumed(units):
+    """A BatchWriteItem response that processed everything"""
+    return {"ConsumedCapacity": [{"TableName": "table", "CapacityUnits": units}]}
+
+
+class TestTokenBucket(TestCase):
+    """Tests for TokenBucket"""
+
+    def test_paces_to_rate(self):
+        """Consuming more than the rate sleeps for the shortfall"""
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, timer=clock.timer, sleep=clock.sleep)
+        bucket.consume(10)
+        self.assertEqual(clock.slept, [])
+        bucket.consume(5)
+        self.assertAlmostEqual(clock.slept[0], 0.5)
+
+    def test_adapts(self):
+        """The rate backs off multiplicatively and recovers additively"""
+        bucket = TokenBucket(rate=100, max_rate=130)
+        bucket.backoff()
+        self.assertEqual(bucket.rate, 50)
+        bucket.speedup()
+        bucket.speedup()
+        bucket.speedup()
+        self.assertEqual(bucket.rate, 125)
+        bucket.speedup()
+        self.assertEqual(bucket.rate, 130)
+
+
+class TestBatchWriter(TestCase):
+    """Tests for BatchWriter"""
+
+    def test_pages(self):
+        """Items are sent in pages of 25"""
+        clock = FakeClock()
+        conn = mock_connection(consumed(25), consumed(5))
+        with BatchWriter(
+            mock_model(), connection=conn, timer=clock.timer, sleep=clock.sleep
+        ) as batch:
+            for i in range(30):
+                batch.save(mock_item(str(i)))
+        calls = conn.batch_write_item.call_args_list
+        self.assertEqual([len(c.kwargs["put_items"]) for c in calls], [25, 5])
+        self.assertEqual(batch.stats()["items"], 30)
+        self.assertEqual(batch.stats()["capacity"], 30)
+
+    def test_unprocessed_retry(self):
+        """Unprocessed items are retried after a backoff"""
+        clock = FakeClock()
+        unprocessed = {
+            "UnprocessedItems": {"table": [{"DeleteRequest": {"Key": {"key": "b"}}}]}
+        }
+        conn = mock_connection(unprocessed, consumed(1))
+        with BatchWriter(
+            mock_model(), connection=conn, timer=clock.timer, sleep=clock.sleep
+        ) as batch:
+            batch.save(mock_item("a"))
+            batch.delete(mock_item("b"))
+        calls = conn.batch_write_item.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1].kwargs["delete_items"], [{"key": "b"}])
+        self.assertEqual(calls[1].kwargs["put_items"], [])
+        self.assertEqual(batch.stats()["retries"], 1)
+
+    def test_throttled_retry(self):
+        """Throttling errors are retried, other errors are raised"""
+        clock = FakeClock()
+        cause = ClientError(
+            {"Error": {"Code": "ProvisionedThroughputExceededException"}},
+            "BatchWriteItem",
+        )
+        throttled = PutError("throttled", cause)
+        conn = mock_connection(throttled, consumed(1))
+        with BatchWriter(
+            mock_model(), connection=conn, timer=clock.timer, sleep=clock.sleep
+        ) as batch:
+            batch.save(mock_item("a"))
+        self.assertEqual(batch.stats()["retries"], 1)
+
+        conn = mock_connection(PutError("broken"))
+        with self.assertRaises(PutError):
+            with BatchWriter(
+                mock_model(), connection=conn, timer=clock.timer, sleep=clock.sleep
+            ) as batch:
+                batch.save(mock_item("a"))
+
+    def test_concurrent(self):
+        """Batches can be written from a thread pool"""
+        clock = FakeClock()
+        conn = mock_connection()
+        conn.batch_write_item.side_effect = lambda put_items, **_: consumed(
+            len(put_items)
+        )
+        with BatchWriter(
+            mock_model(),
+            connection=conn,
+            concurrency=3,
+            timer=clock.timer,
+            sleep=clock.sleep,
+        ) as batch:
+            for i in range(100):
+                batch.save(mock_item(str(i)))
+        self.assertEqual(conn.batch_write_item.call_count, 4)
+        self.assertEqual(batch.stats()["items"], 100)
+        self.assertEqual(batch.stats()["capacity"], 100)
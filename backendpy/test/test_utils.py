@@ -26,3 +26,26 @@ class TestUtils(TestCase):
         """Test cleandomain with a bunch of junk"""
         res = utils.cleandomain("aBc12#$%3_ruie[-")
         self.assertEqual(res, "abc123_ruie-")
+
+    def test_cleandomain_forms(self):
+        """Test cleandomain with ports, handles, paths, IDNA and trailing dots"""
+        cases = {
+            "https://Host.Example:8443/about": "host.example",
+            "@alice@Mastodon.Social": "mastodon.social",
+            "https://mastodon.social/@alice": "mastodon.social",
+            "https://user:pw@host.com/": "host.com",
+            "bücher.example": "xn--bcher-kva.example",
+            " host.example.": "host.example",
+            "host.example.:443": "host.example",
+        }
+        for raw, clean in cases.items():
+            self.assertEqual(utils.cleandomain(raw), clean)
+
+    def test_cleandomains(self):
+        """Test that cleandomains agrees with cleandomain"""
+        raw = ["https://domain", "", "a\nb@c", "aBc12#$%3_ruie[-", "ünï.de", "x.y."]
+        self.assertEqual(
+            utils.cleandomains(raw),
+            [utils.cleandomain(x.replace("\n", "")) for x in raw],
+        )
+        self.assertEqual(utils.cleandomains([]), [])
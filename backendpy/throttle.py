@@ -0,0 +1,221 @@
+"""Rate limiting for bulk DynamoDB operations"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pynamodb.exceptions import PutError
+
+# The most operations DynamoDB accepts in one BatchWriteItem call.
+BATCH_SIZE = 25
+
+# Errors that mean we are going faster than the table allows.
+THROTTLE_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException"}
+
+
+class TokenBucket:  # pylint: disable=too-many-instance-attributes
+    """Paces work to an adaptive rate of capacity units per second.
+
+    The rate grows additively while requests succeed, and is halved whenever
+    the table pushes back."""
+
+    def __init__(
+        self,
+        rate=400.0,
+        *,
+        max_rate=4000.0,
+        min_rate=1.0,
+        timer=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.timer = timer
+        self.sleep = sleep
+        self.tokens = rate
+        self.last = timer()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Adds the tokens earned since the last refill"""
+        now = self.timer()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, units):
+        """Spends units of capacity, sleeping if we have run ahead of the rate"""
+        # Holding the lock while sleeping is deliberate: it paces every
+        # thread sharing this bucket.
+        with self.lock:
+            self.refill()
+            self.tokens -= units
+            if self.tokens < 0:
+                self.sleep(-self.tokens / self.rate)
+                self.refill()
+
+    def speedup(self):
+        """Called after a request that was not throttled"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + BATCH_SIZE)
+
+    def backoff(self):
+        """Called after a request that was throttled"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+
+class BatchWriter:  # pylint: disable=too-many-instance-attributes
+    """A replacement for pynamodb's Model.batch_write() that is paced by a
+    TokenBucket using the capacity each write reports, and retries unprocessed
+    items with jittered exponential backoff.
+
+    With concurrency > 1, full batches are sent from a bounded thread pool
+    that shares the one TokenBucket.  connection defaults to the model's own
+    table connection."""
+
+    def __init__(
+        self,
+        model,
+        bucket=None,
+        *,
+        connection=None,
+        concurrency=1,
+        max_retries=8,
+        base_delay=0.05,
+        timer=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.model = model
+        if connection is None:
+            connection = model._get_connection()  # pylint: disable=protected-access
+        self.connection = connection
+        self.bucket = bucket or TokenBucket(timer=timer, sleep=sleep)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.timer = timer
+        self.sleep = sleep
+        self.puts = []
+        self.deletes = []
+        self.items = 0
+        self.capacity = 0.0
+        self.retries = 0
+        self.started = timer()
+        self.concurrency = concurrency
+        self.pool = ThreadPoolExecutor(concurrency) if concurrency > 1 else None
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+                self.drain(0)
+                logging.info("%s batch write: %s", self.model.__name__, self.stats())
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+
+    def save(self, item):
+        """Queues an item to be written"""
+        self.puts.append(item.serialize())
+        self.pending()
+
+    def delete(self, item):
+        """Queues an item to be deleted"""
+        self.deletes.append(item._get_keys())  # pylint: disable=protected-access
+        self.pending()
+
+    def pending(self):
+        """Sends a batch once we have a full one"""
+        if len(self.puts) + len(self.deletes) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes everything that is queued"""
+        puts, deletes = self.puts, self.deletes
+        self.puts, self.deletes = [], []
+        if not (puts or deletes):
+            return
+        if self.pool is None:
+            self.write(puts, deletes)
+            return
+        # Keep at most a couple of batches queued per thread, so that memory
+        # stays bounded when the caller is faster than the table.
+        self.drain(2 * self.concurrency - 1)
+        self.futures.add(self.pool.submit(self.write, puts, deletes))
+
+    def drain(self, limit):
+        """Waits until at most limit batches are in flight, raising any
+        errors from the ones that finished"""
+        while len(self.futures) > limit:
+            done, self.futures = wait(self.futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    def write(self, puts, deletes):
+        """Sends one BatchWriteItem, retrying until every item is processed"""
+        conn = self.connection
+        table = self.model.Meta.table_name
+        count = len(puts) + len(deletes)
+        attempt = 0
+        while puts or deletes:
+            try:
+                data = conn.batch_write_item(
+                    put_items=puts,
+                    delete_items=deletes,
+                    return_consumed_capacity="TOTAL",
+                )
+            except PutError as e:
+                if e.cause_response_code not in THROTTLE_CODES:
+                    raise
+                data = None
+
+            if data is not None:
+                used = sum(
+                    c.get("CapacityUnits", 0) for c in data.get("ConsumedCapacity", [])
+                )
+                with self.lock:
+                    self.capacity += used
+                self.bucket.consume(used)
+                unprocessed = data.get("UnprocessedItems", {}).get(table, [])
+                puts = [
+                    x["PutRequest"]["Item"] for x in unprocessed if "PutRequest" in x
+                ]
+                deletes = [
+                    x["DeleteRequest"]["Key"]
+                    for x in unprocessed
+                    if "DeleteRequest" in x
+                ]
+                if not unprocessed:
+                    self.bucket.speedup()
+                    break
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise PutError(f"Failed to batch write items after {attempt} attempts")
+            with self.lock:
+                self.retries += 1
+            self.bucket.backoff()
+            # Full jitter, so that concurrent writers don't retry in lockstep.
+            self.sleep(random.uniform(0, self.base_delay * 2**attempt))
+
+        with self.lock:
+            self.items += count
+
+    def stats(self):
+        """Returns counts and throughput for the writes so far"""
+        elapsed = max(self.timer() - self.started, 1e-6)
+        return {
+            "items": self.items,
+            "capacity": self.capacity,
+            "retries": self.retries,
+            "rate": self.bucket.rate,
+            "items_per_sec": self.items / elapsed,
+        }
@@ -1,8 +1,24 @@
 """Utility functions"""
 
+import importlib.util
 import json
 import logging
 import re
+import sys
+
+
+def lazy_import(name):
+    """Returns a module that is only loaded on first attribute access, so
+    that handlers which never touch it don't pay for importing it"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
 
 def get_cookie(event):
@@ -43,32 +59,45 @@ def badhost_response(host):
     return response(json.dumps(obj), statusCode=500)
 
 
-def cleandomain(domain):
-    """Clean up a domain input - all lowercase, no @"""
-    if domain is None:
-        return domain
+# One pass over a domain as typed by a user: an optional URL scheme, any
+# number of "user@" prefixes (for @user@host), then the host up to a path or
+# port.
+DOMAIN_PATTERN = r"[ \t]*(?:[a-z][a-z0-9+.-]*://)?(?:[^@/\n]*@)*([^@/:\n]*)"
+DOMAIN_RE = re.compile(DOMAIN_PATTERN)
+DOMAINS_RE = re.compile(r"^" + DOMAIN_PATTERN + r"[^\n]*(?:\n|\Z)", re.M)
+# What's left that can't be in a host name
+GARBAGE_RE = re.compile(r"[^a-z0-9_.\n-]+")
 
-    # Clean up some common problems:
-    # - https://domain
-    # - http://domain
-    # - username@domain
 
-    ldomain = domain.lower()
+def to_ascii(host):
+    """Converts an internationalized host name to its punycode form"""
+    try:
+        return host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return host
 
-    # The URL cases
-    m = re.match("https://([^/]*)", ldomain)
-    if m is not None:
-        return m.group(1)
 
-    m = re.match("http://([^/]*)", ldomain)
-    if m is not None:
-        return m.group(1)
-
-    # The username case
-    m = re.match("([^@]*)@([a-zA-Z0-9_.-]*)", ldomain)
-    if m is not None:
-        return m.group(2)
+def cleandomain(domain):
+    """Clean up a domain input - all lowercase, no @, scheme, path or port"""
+    if domain is None:
+        return domain
 
-    # Otherwise, just get rid of garbage.
-    return re.sub("[^a-zA-Z0-9_.-]", "", ldomain)
-    # return domain.strip().lower().replace("@", "")
+    host = DOMAIN_RE.match(domain.lower().replace("\n", "")).group(1)
+    if not host.isascii():
+        host = to_ascii(host)
+    return GARBAGE_RE.sub("", host).rstrip(".")
+
+
+def cleandomains(domains):
+    """Cleans up many domains at once, like cleandomain"""
+    domains = [d.replace("\n", "") for d in domains]
+    if not domains:
+        return []
+    # Matching every domain as one line of a single text keeps the work in
+    # the regex engine rather than a Python call per domain.
+    text = "\n".join(domains).lower()
+    hosts = [m.group(1) for m in DOMAINS_RE.finditer(text)]
+    text = "\n".join(hosts)
+    if not text.isascii():
+        text = "\n".join(to_ascii(h) for h in hosts)
+    return [h.rstrip(".") for h in GARBAGE_RE.sub("", text).split("\n")]
@@ -34,6 +34,11 @@ function LoginForm() {
         } else if (data.status === "blocked") {
           setError("That host does not supoport this app.");
           setEnabled(true);
+        } else if (data.status === "busy") {
+          setError(
+            "Still setting things up with your server.  Try again in a moment."
+          );
+          setEnabled(true);
         } else if (data.status === "not_allowed") {
           setError("Looks like your domain is not currently supported!");
           setEnabled(true);
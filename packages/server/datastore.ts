@@ -3,6 +3,8 @@ import { DynamoDBClient } from "@aws-sdk/client-dynamodb";
 import { attribute, hashKey, table } from "@nova-odm/annotations";
 import { DataMapper } from "@nova-odm/mapper";
 
+import { isSealed, openCookie } from "./sessions";
+
 // A class representing stored authentication information.
 @table(process.env.TABLE_AUTH || "list-manager")
 export class AuthTable {
@@ -32,11 +34,73 @@ export class HostCfgTable {
   client_secret: string;
 }
 
+// Sealed session cookies that were logged out before they expired.
+@table(process.env.TABLE_REVOKED || "list-manager")
+export class RevokedSessionTable {
+  @hashKey()
+  jti: string;
+
+  @attribute()
+  expires_at: number;
+}
+
+// How long (in ms) to remember whether a session was logged out, as the
+// Python handlers do (CACHE_TTL_AUTH), and how many sessions to remember.
+const REVOKED_TTL = 1000 * parseInt(process.env.CACHE_TTL_AUTH || "60");
+const REVOKED_MAX = 1024;
+
+// Session id -> whether it is revoked, and until when we trust that
+const revokedCache = new Map<string, { revoked: boolean; until: number }>();
+
+// Returns true if a sealed session has been logged out.  Results are cached
+// for REVOKED_TTL, so most requests need no table read.
+async function isRevoked(mapper: DataMapper, jti: string): Promise<boolean> {
+  const now = Date.now();
+  const cached = revokedCache.get(jti);
+  if (cached && cached.until > now) return cached.revoked;
+
+  const toFetch = new RevokedSessionTable();
+  toFetch.jti = jti;
+  const revoked = await mapper
+    .get({ item: toFetch })
+    .then(() => true)
+    .catch((err) => {
+      if (err.name != "ItemNotFoundException") throw err;
+      return false;
+    });
+
+  // Maps iterate in insertion order, so the first key is the oldest.
+  revokedCache.delete(jti);
+  if (revokedCache.size >= REVOKED_MAX)
+    revokedCache.delete(revokedCache.keys().next().value as string);
+  revokedCache.set(jti, { revoked: revoked, until: now + REVOKED_TTL });
+  return revoked;
+}
+
+// Given a sealed cookie, return the login information in it, or null if it
+// doesn't open or has been logged out.
+async function getSealedAuth(
+  mapper: DataMapper,
+  cookie: string
+): Promise<AuthTable | null> {
+  const session = openCookie(cookie);
+  if (!session || (await isRevoked(mapper, session.jti))) return null;
+
+  const auth = new AuthTable();
+  auth.key = session.key;
+  auth.token = session.token;
+  auth.domain = session.domain;
+  auth.expires_at = String(session.expires_at);
+  return auth;
+}
+
 // Given a cookie, return stored login information
-export async function getAuth(cookie: string): Promise<AuthTable> {
+export async function getAuth(cookie: string): Promise<AuthTable | null> {
   const client = new DynamoDBClient({ region: "us-west-2" });
   const mapper = new DataMapper({ client: client });
 
+  if (isSealed(cookie)) return getSealedAuth(mapper, cookie);
+
   const toFetch = new AuthTable();
   toFetch.key = cookie;
   return mapper.get({ item: toFetch }).then((ret) => {
@@ -0,0 +1,39 @@
+// Unit under test
+const mod = await import("./sessions");
+const isSealed = mod.isSealed;
+const openCookie = mod.openCookie;
+const parseKeys = mod.parseKeys;
+
+// Sealed by backendpy/sessions.py with the key below, expiring in 2100.
+const COOKIE =
+  "s1.a.SvWzR2Ngo02a38W2G2y22FxqnwsK05ZxN2lHAUSfRA8oZqD-LQIeG5uoT-I5PQBUR3sb6uTiRBGEl9aagFyGJUozALMKTmyAOG5aYPBazZ3BTaey4THlpKfGIw5wM7MjwLG8CHtYfNphT7IqWiq30oRK6AD2";
+// The same, but expired in 1970.
+const EXPIRED =
+  "s1.a.svyt1IrUWMHP7i4m0TxG0BNd_qboNPf8LAO8wA-syXouA98t7IeRCorCUvxbnPl3CL1oNeAItYKW1LvG4QJcFYiJ7mfeC9bc2d4NCUA2_cCBJ30u-RSmnyMqgeC-u2WuAeazd7mLK59iZJ5UYBna";
+const KEYS = parseKeys("a:a2tra2tra2tra2tra2tra2tra2tra2tra2tra2tra2s=");
+
+test("opens python cookies", () => {
+  expect(isSealed(COOKIE)).toBe(true);
+  expect(isSealed("urn:uuid:1234")).toBe(false);
+
+  const session = openCookie(COOKIE, KEYS);
+  expect(session.domain).toBe("mydomain");
+  expect(session.token).toBe("token");
+  expect(session.key).toBe(COOKIE);
+});
+
+test("rejects tampered cookies", () => {
+  const forged = COOKIE.slice(0, -2) + (COOKIE.endsWith("A") ? "BA" : "AA");
+  expect(openCookie(forged, KEYS)).toBeNull();
+  expect(openCookie(COOKIE.replace("s1.a.", "s1.b."), KEYS)).toBeNull();
+  expect(openCookie("s1.a", KEYS)).toBeNull();
+});
+
+test("rejects expired cookies", () => {
+  expect(openCookie(EXPIRED, KEYS)).toBeNull();
+});
+
+test("rejects bad keys", () => {
+  expect(() => parseKeys("a:c2hvcnQ")).toThrow();
+  expect(parseKeys("").size).toBe(0);
+});
@@ -0,0 +1,83 @@
+// Opens the sealed session cookies issued by backendpy/sessions.py, which
+// describes the format.
+
+import { createDecipheriv } from "crypto";
+import type { CipherGCMTypes } from "crypto";
+
+// Marks a sealed cookie (table cookies are uuid URNs)
+const PREFIX = "s1";
+
+const NONCE_SIZE = 12;
+const TAG_SIZE = 16;
+
+// The contents of a sealed cookie
+export interface Session {
+  key: string;
+  token: string;
+  domain: string;
+  expires_at: number;
+  jti: string;
+}
+
+// Parses SESSION_KEYS ("id:base64url key" pairs, separated by commas) into a
+// map from key id to key.
+export function parseKeys(spec: string): Map<string, Buffer> {
+  const keys = new Map<string, Buffer>();
+  for (const item of spec.split(",")) {
+    if (!item.trim()) continue;
+    const [kid, secret] = item.trim().split(":", 2);
+    const key = Buffer.from(secret || "", "base64url");
+    if (!kid || kid.includes(".") || ![16, 24, 32].includes(key.length))
+      throw new Error(`Bad session key ${kid}`);
+    keys.set(kid, key);
+  }
+  return keys;
+}
+
+const sessionKeys = parseKeys(process.env.SESSION_KEYS || "");
+
+// Returns true if a cookie is (or claims to be) a sealed one
+export function isSealed(cookie: string): boolean {
+  return cookie.startsWith(PREFIX + ".");
+}
+
+// Returns the session in a sealed cookie, or null if it is forged, sealed
+// with a key we no longer have, or expired.  Revocation is checked by the
+// caller, see Datastore.getAuth.
+export function openCookie(
+  cookie: string,
+  keys: Map<string, Buffer> = sessionKeys,
+  now: number = Date.now() / 1000
+): Session | null {
+  const parts = cookie.split(".");
+  if (parts.length != 3 || parts[0] != PREFIX) return null;
+  const [prefix, kid, body] = parts;
+  const key = keys.get(kid);
+  const raw = Buffer.from(body, "base64url");
+  if (!key || raw.length < NONCE_SIZE + TAG_SIZE) return null;
+
+  const cipher = `aes-${key.length * 8}-gcm` as CipherGCMTypes;
+  const decipher = createDecipheriv(cipher, key, raw.subarray(0, NONCE_SIZE));
+  decipher.setAAD(Buffer.from(`${prefix}.${kid}.`, "ascii"));
+  decipher.setAuthTag(raw.subarray(raw.length - TAG_SIZE));
+  let payload: Buffer;
+  try {
+    payload = Buffer.concat([
+      decipher.update(raw.subarray(NONCE_SIZE, raw.length - TAG_SIZE)),
+      decipher.final(),
+    ]);
+  } catch (err) {
+    console.warn(`sessions: bad tag on cookie for key ${kid}`);
+    return null;
+  }
+
+  const data = JSON.parse(payload.toString("utf-8"));
+  if (data.e <= now) return null;
+  return {
+    key: cookie,
+    token: data.t,
+    domain: data.d,
+    expires_at: data.e,
+    jti: data.j,
+  };
+}
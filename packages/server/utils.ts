@@ -60,6 +60,7 @@ export const gen_handler = async (
     if (!masto) return auth_response();
 
     return Datastore.getAuth(cookie).then((auth) => {
+      if (!auth) return auth_response();
       const domain = auth.domain;
 
       // FIXME: ok_response assumes that the response is an object.  info_following()